@@ -1,28 +1,179 @@
-import os, asyncpg, random, string, time
+import os, asyncio, asyncpg, gzip, hashlib, math, random, string, time
 from typing import List, Optional, Dict
 from datetime import datetime, timedelta, timezone
 
 UTC = timezone.utc
 def now(): return datetime.now(UTC)
 
+TICKET_MSG_COLUMNS = ["ticket_id", "channel_id", "author_id", "content", "attachments", "created_at"]
+TICKET_MSG_PAGE = 500   # filas por página al leer un ticket con cursor
+TRANSCRIPT_GZIP_LEVEL = 6
+TMSG_PARTITIONS_AHEAD = 2   # meses futuros con partición ya creada
+# errores propios de las filas (datos inválidos, FK de un ticket borrado): reintentar el mismo lote no sirve
+ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+class AliasSampler:
+    """Muestreo ponderado O(1) por extracción (método alias de Walker, construcción de Vose)."""
+    def __init__(self, items: List, weights: List[float]):
+        n = len(items)
+        self.items = list(items)
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        total = float(sum(weights))
+        if not n or total <= 0:
+            return
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # lo que queda (incluido el error de redondeo) es probabilidad 1
+
+    def __len__(self):
+        return len(self.items)
+
+    def draw(self, rng=random):
+        i = int(rng.random() * len(self.items))
+        return self.items[i] if rng.random() < self.prob[i] else self.items[self.alias[i]]
+
+MAX_KEYS_PER_BATCH = 100_000
+KEY_INSERT_CHUNK = 10_000
+CODE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+
+KEY_FILTER_FP_RATE = 0.001
+KEY_FILTER_MIN_CAPACITY = 100_000
+
+class BloomFilter:
+    """Filtro de Bloom: si dice que no, el elemento seguro no está (sin falsos negativos)."""
+    def __init__(self, capacity: int, fp_rate: float = KEY_FILTER_FP_RATE):
+        self.capacity = max(1, int(capacity))
+        self.fp_rate = fp_rate
+        self.m = max(64, int(math.ceil(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        self.k = max(1, round(self.m / self.capacity * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        h = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(h[:8], "little"), int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def add(self, item: str):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def estimated_fp_rate(self) -> float:
+        return (1.0 - math.exp(-self.k * self.count / self.m)) ** self.k
+
 def codegen():
-    alphabet = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
-    def grp(n=4): return "".join(random.choice(alphabet) for _ in range(n))
-    return f"{grp()}-{grp()}-{grp()}"
+    s = "".join(random.choices(CODE_ALPHABET, k=12))
+    return f"{s[:4]}-{s[4:8]}-{s[8:]}"
+
+def month_start(d: datetime) -> datetime:
+    return datetime(d.year, d.month, 1, tzinfo=UTC)
+
+def next_month(d: datetime) -> datetime:
+    return datetime(d.year + (d.month == 12), d.month % 12 + 1, 1, tzinfo=UTC)
+
+def tmsg_partition_name(d: datetime) -> str:
+    return f"ticket_messages_p{d.year:04d}{d.month:02d}"
 
 class Database:
-    def __init__(self, dsn: str):
+    def __init__(self, dsn: str, partition_ticket_messages: bool = False, listen_dsn: str | None = None):
         self.dsn = dsn
+        # LISTEN necesita una sesión propia y directa (los poolers en modo transacción no la soportan)
+        self.listen_dsn = listen_dsn or dsn
+        # ticket_messages particionada por mes en created_at (opt-in: migra la tabla existente en init)
+        self.partition_ticket_messages = partition_ticket_messages
         self.pool: asyncpg.Pool | None = None
+        # caché de config por guild: se rellena en get_config y los setters la refrescan/invalidan
+        self._cfg_cache: Dict[int, dict] = {}
+        self._cfg_gen = 0
+        self.cfg_hits = 0
+        self.cfg_misses = 0
+        self.config_listeners: List = []   # callables(guild_id) avisados tras cada cambio de config
+        # índice anti-ping en memoria: guild_id -> usuarios protegidos (carga perezosa por guild)
+        self._antiping: Dict[int, frozenset] = {}
+        self._antiping_gen = 0
+        self.antiping_loads = 0
+        # tickets abiertos: channel_id -> ticket_id (se calienta al arrancar con warm_ticket_index)
+        self._open_tickets: Dict[int, int] = {}
+        # sampler de premios para keys random; se reconstruye solo cuando cambia el set de premios
+        self._prize_sampler: AliasSampler | None = None
+        self._prize_gen = 0
+        self._prize_loading: Dict[int, asyncio.Future] = {}   # versión -> carga del sampler en curso
+        self.prize_sampler_builds = 0
+        # filtro de Bloom de códigos emitidos: descarta códigos inventados sin tocar la DB
+        self._key_filter: BloomFilter | None = None
+        self._key_filter_pending: List[str] | None = None   # códigos creados mientras se reconstruye
+        self._key_filter_task: asyncio.Task | None = None
+        self._key_inflight: List[set] = []   # códigos ya en el filtro cuya transacción aún no confirmó
+        self.key_filter_stats = {"rejected": 0, "passed": 0, "builds": 0, "build_errors": 0}
+        self.archive_stats = {"archived": 0, "raw_bytes": 0, "gz_bytes": 0}
+        # participantes de giveaways en memoria: estado + set de usuarios por giveaway; las altas se vuelcan en lote
+        self._gw: Dict[int, dict] = {}                    # giveaway_id -> {"status": str, "users": set}
+        self._gw_loading: Dict[int, asyncio.Future] = {}
+        self._gw_msg: Dict[int, int] = {}                 # message_id -> giveaway_id
+        self._gw_buf: List[tuple] = []                    # (giveaway_id, user_id, joined_at) pendientes
+        self._gw_lock = asyncio.Lock()
+        self._gw_task: asyncio.Task | None = None
+        self.gw_flush_rows = 500
+        self.gw_flush_interval = 1.0
+        self.gw_stats = {"entries": 0, "duplicates": 0, "rejected": 0, "loads": 0, "flushes": 0, "rows": 0, "errors": 0,
+                         "draws": 0, "rerolls": 0, "winners": 0}
+        # buffer write-behind de ticket_messages: se vuelca con COPY por tamaño o por tiempo
+        self._tmsg_buf: List[tuple] = []
+        # snapshots de autor (nombre, avatar, staff) por ticket abierto; solo se encolan si cambian
+        self._tauthors: Dict[int, Dict[int, tuple]] = {}
+        self._tauthor_buf: Dict[tuple, tuple] = {}   # (ticket_id, author_id) -> snapshot pendiente
+        self._tmsg_lock = asyncio.Lock()
+        self._tmsg_task: asyncio.Task | None = None
+        self.tmsg_flush_rows = 200      # vuelco anticipado
+        self.tmsg_max_rows = 5000       # tope duro: por encima el llamador espera al vuelco
+        self.tmsg_flush_interval = 2.0
+        self.tmsg_stats = {"flushes": 0, "rows": 0, "errors": 0, "dropped": 0, "rejected": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
 
     async def connect(self):
         # tamaños conservadores para hosts tipo Render/Railway
         self.pool = await asyncpg.create_pool(dsn=self.dsn, min_size=1, max_size=5)
 
+    async def listen(self, channel: str, callback, on_lost=None) -> asyncpg.Connection:
+        """Conexión dedicada (fuera del pool) con LISTEN en `channel`; callback(payload) por cada NOTIFY."""
+        conn = await asyncpg.connect(dsn=self.listen_dsn)
+        await conn.add_listener(channel, lambda _c, _pid, _ch, payload: callback(payload))
+        if on_lost:
+            conn.add_termination_listener(lambda _c: on_lost())
+        return conn
+
     async def close(self):
         if self.pool:
+            try: await self.flush_ticket_messages()
+            except Exception: pass
+            try: await self.flush_giveaway_entries()
+            except Exception: pass
             await self.pool.close()
 
+    def stats(self) -> dict:
+        return {
+            "config_cache": {"size": len(self._cfg_cache), "hits": self.cfg_hits, "misses": self.cfg_misses},
+            "antiping_index": {"guilds": len(self._antiping), "users": sum(len(v) for v in self._antiping.values()),
+                               "loads": self.antiping_loads},
+            "open_tickets_index": {"size": len(self._open_tickets)},
+            "prize_sampler": {"prizes": len(self._prize_sampler) if self._prize_sampler else 0, "builds": self.prize_sampler_builds},
+            "key_filter": self.key_filter_info(),
+            "transcript_archive": dict(self.archive_stats),
+            "giveaway_entries": {"giveaways": len(self._gw), "buffered": len(self._gw_buf), **self.gw_stats},
+            "ticket_log_buffer": {"buffered": len(self._tmsg_buf), "authors_buffered": len(self._tauthor_buf), **self.tmsg_stats,
+                                  "avg_ms": self.tmsg_stats["total_ms"] / max(1, self.tmsg_stats["flushes"])},
+        }
+
     async def init(self):
         q = """
         CREATE TABLE IF NOT EXISTS config(
@@ -91,6 +242,18 @@ class Database:
           created_at TIMESTAMPTZ DEFAULT NOW()
         );
         CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages(ticket_id);
+        CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket_ts ON ticket_messages(ticket_id, created_at);
+
+        -- Cómo se veía cada autor del ticket al escribir (para la transcripción sin consultar miembros)
+        CREATE TABLE IF NOT EXISTS ticket_authors(
+          ticket_id BIGINT NOT NULL REFERENCES tickets(id) ON DELETE CASCADE,
+          author_id BIGINT NOT NULL,
+          display_name TEXT NOT NULL,
+          avatar_url TEXT,
+          is_staff BOOLEAN NOT NULL DEFAULT FALSE,
+          updated_at TIMESTAMPTZ DEFAULT NOW(),
+          PRIMARY KEY (ticket_id, author_id)
+        );
 
         -- Roles extra que pueden ver tickets
         CREATE TABLE IF NOT EXISTS ticket_allowed_roles(
@@ -99,6 +262,20 @@ class Database:
           PRIMARY KEY(guild_id, role_id)
         );
 
+        -- Transcripciones archivadas: blobs gzip direccionados por el sha256 del contenido sin comprimir
+        CREATE TABLE IF NOT EXISTS transcript_blobs(
+          sha256 TEXT PRIMARY KEY,
+          gz BYTEA NOT NULL,
+          size INT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ticket_transcripts(
+          ticket_id BIGINT PRIMARY KEY REFERENCES tickets(id) ON DELETE CASCADE,
+          guild_id BIGINT NOT NULL,
+          txt_sha256 TEXT NOT NULL REFERENCES transcript_blobs(sha256),
+          html_sha256 TEXT NOT NULL REFERENCES transcript_blobs(sha256),
+          archived_at TIMESTAMPTZ DEFAULT NOW()
+        );
+
         -- Paneles publicados (para evitar duplicados)
         CREATE TABLE IF NOT EXISTS ticket_panels(
           guild_id BIGINT NOT NULL,
@@ -165,6 +342,17 @@ class Database:
           created_at TIMESTAMPTZ DEFAULT NOW()
         );
         CREATE INDEX IF NOT EXISTS idx_giveaways_due ON giveaways(status, ends_at);
+        CREATE INDEX IF NOT EXISTS idx_giveaways_message ON giveaways(message_id);
+
+        -- Avisar a los procesos que escuchan cuando un giveaway se crea o cambia de estado/fin
+        CREATE OR REPLACE FUNCTION giveaways_notify() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify('giveaways', NEW.id::text);
+          RETURN NEW;
+        END $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS trg_giveaways_notify ON giveaways;
+        CREATE TRIGGER trg_giveaways_notify AFTER INSERT OR UPDATE OF status, ends_at ON giveaways
+          FOR EACH ROW EXECUTE FUNCTION giveaways_notify();
 
         CREATE TABLE IF NOT EXISTS giveaway_entries(
           giveaway_id BIGINT NOT NULL REFERENCES giveaways(id) ON DELETE CASCADE,
@@ -172,6 +360,14 @@ class Database:
           joined_at TIMESTAMPTZ DEFAULT NOW(),
           PRIMARY KEY(giveaway_id, user_id)
         );
+        -- Ganadores de cada ronda (0 = sorteo inicial, 1.. = rerolls); los rerolls los excluyen
+        CREATE TABLE IF NOT EXISTS giveaway_winners(
+          giveaway_id BIGINT NOT NULL REFERENCES giveaways(id) ON DELETE CASCADE,
+          user_id BIGINT NOT NULL,
+          round INT NOT NULL DEFAULT 0,
+          picked_at TIMESTAMPTZ DEFAULT NOW(),
+          PRIMARY KEY(giveaway_id, user_id)
+        );
 
         -- GOLD Accounts: separadas por guild y admin
         CREATE TABLE IF NOT EXISTS gold_accounts(
@@ -187,41 +383,180 @@ class Database:
         """
         async with self.pool.acquire() as c:
             await c.execute(q)
+        if self.partition_ticket_messages:
+            await self._migrate_ticket_messages_partitioned()
+            await self.ensure_ticket_partitions()
+
+    # ---------- ticket_messages particionada ----------
+    async def _migrate_ticket_messages_partitioned(self):
+        """Convierte ticket_messages en tabla particionada por mes (una sola vez; no hace nada si ya lo es)."""
+        async with self.pool.acquire() as c:
+            kind = await c.fetchval("SELECT relkind FROM pg_class WHERE oid = 'ticket_messages'::regclass")
+            if kind == "p":
+                return
+            async with c.transaction():
+                await c.execute("LOCK TABLE ticket_messages IN ACCESS EXCLUSIVE MODE")
+                lo = await c.fetchval("SELECT MIN(created_at) FROM ticket_messages")
+                await c.execute("""
+                    ALTER TABLE ticket_messages RENAME TO ticket_messages_legacy;
+                    DROP INDEX IF EXISTS idx_ticket_messages_ticket;
+                    DROP INDEX IF EXISTS idx_ticket_messages_ticket_ts;
+                    CREATE TABLE ticket_messages(
+                      id BIGSERIAL,
+                      ticket_id BIGINT NOT NULL REFERENCES tickets(id) ON DELETE CASCADE,
+                      channel_id BIGINT NOT NULL,
+                      author_id BIGINT NOT NULL,
+                      content TEXT,
+                      attachments TEXT[],
+                      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                      PRIMARY KEY (id, created_at)
+                    ) PARTITION BY RANGE (created_at);
+                    CREATE TABLE ticket_messages_default PARTITION OF ticket_messages DEFAULT;
+                    CREATE INDEX idx_ticket_messages_ticket ON ticket_messages(ticket_id);
+                    CREATE INDEX idx_ticket_messages_ticket_ts ON ticket_messages(ticket_id, created_at);
+                """)
+                await self._create_month_partitions(c, month_start(lo or now()))
+                await c.execute("""
+                    INSERT INTO ticket_messages(id, ticket_id, channel_id, author_id, content, attachments, created_at)
+                    SELECT id, ticket_id, channel_id, author_id, content, attachments, COALESCE(created_at, NOW())
+                    FROM ticket_messages_legacy;
+                    SELECT setval(pg_get_serial_sequence('ticket_messages', 'id'),
+                                  GREATEST((SELECT MAX(id) FROM ticket_messages), 1));
+                    DROP TABLE ticket_messages_legacy;
+                """)
+        print("[db] ticket_messages migrada a tabla particionada por mes")
+
+    @staticmethod
+    async def _create_month_partitions(c, start: datetime) -> int:
+        end = month_start(now())
+        for _ in range(TMSG_PARTITIONS_AHEAD): end = next_month(end)
+        made = 0
+        m = start
+        while m <= end:
+            made += await c.fetchval("SELECT to_regclass($1) IS NULL", tmsg_partition_name(m))
+            await c.execute(f"""
+                CREATE TABLE IF NOT EXISTS {tmsg_partition_name(m)} PARTITION OF ticket_messages
+                FOR VALUES FROM ('{m.isoformat()}') TO ('{next_month(m).isoformat()}')
+            """)
+            m = next_month(m)
+        return made
+
+    async def ensure_ticket_partitions(self) -> int:
+        """Crea las particiones del mes actual y los siguientes; devuelve cuántas eran nuevas."""
+        async with self.pool.acquire() as c:
+            return await self._create_month_partitions(c, month_start(now()))
+
+    async def ticket_partitions(self) -> List[Dict]:
+        """Particiones mensuales de ticket_messages con su límite superior, de la más antigua a la más nueva."""
+        async with self.pool.acquire() as c:
+            rows = await c.fetch("""
+                SELECT ch.relname AS name
+                FROM pg_inherits i
+                JOIN pg_class ch ON ch.oid = i.inhrelid
+                WHERE i.inhparent = 'ticket_messages'::regclass AND ch.relname ~ '^ticket_messages_p[0-9]{6}$'
+                ORDER BY ch.relname
+            """)
+        out = []
+        for r in rows:
+            y, mo = int(r["name"][-6:-2]), int(r["name"][-2:])
+            out.append({"name": r["name"], "upper": next_month(datetime(y, mo, 1, tzinfo=UTC))})
+        return out
+
+    async def expired_ticket_partitions(self, retention_days: int) -> List[Dict]:
+        """Particiones enteras anteriores a la retención cuyos tickets ya están todos cerrados."""
+        cutoff = now() - timedelta(days=retention_days)
+        out = []
+        for p in await self.ticket_partitions():
+            if p["upper"] > cutoff: break
+            async with self.pool.acquire() as c:
+                busy = await c.fetchval(f"""
+                    SELECT EXISTS(SELECT 1 FROM {p["name"]} m JOIN tickets t ON t.id = m.ticket_id WHERE t.status <> 'closed')
+                """)
+                p["unarchived"] = [int(x["id"]) for x in await c.fetch(f"""
+                    SELECT DISTINCT t.id FROM {p["name"]} m JOIN tickets t ON t.id = m.ticket_id
+                    WHERE NOT EXISTS(SELECT 1 FROM ticket_transcripts a WHERE a.ticket_id = t.id)
+                """)] if not busy else []
+            if not busy: out.append(p)
+        return out
+
+    async def drop_ticket_partition(self, name: str, detach: bool = False):
+        if not name.startswith("ticket_messages_p") or not name[17:].isdigit():
+            raise ValueError(name)
+        async with self.pool.acquire() as c:
+            if detach:
+                await c.execute(f"ALTER TABLE ticket_messages DETACH PARTITION {name}")
+            else:
+                await c.execute(f"DROP TABLE {name}")
 
     # ---------- Config general ----------
+    def _cfg_store(self, guild_id: int, row):
+        self._cfg_gen += 1
+        if row:
+            self._cfg_cache[guild_id] = dict(row)
+        else:
+            self._cfg_cache.pop(guild_id, None)
+        self._cfg_notify(guild_id)
+
+    def _cfg_evict(self, guild_id: int):
+        self._cfg_gen += 1
+        self._cfg_cache.pop(guild_id, None)
+        self._cfg_notify(guild_id)
+
+    def _cfg_notify(self, guild_id: int):
+        for fn in self.config_listeners:
+            try: fn(guild_id)
+            except Exception: pass
+
     async def get_config(self, guild_id: int) -> dict:
+        cfg = self._cfg_cache.get(guild_id)
+        if cfg is not None:
+            self.cfg_hits += 1
+            return dict(cfg)
+        self.cfg_misses += 1
+        gen = self._cfg_gen
         async with self.pool.acquire() as c:
             row = await c.fetchrow("SELECT * FROM config WHERE guild_id=$1", guild_id)
-            return dict(row) if row else {}
+        cfg = dict(row) if row else {}
+        # si un setter escribió mientras leíamos, no guardar un valor viejo
+        if gen == self._cfg_gen:
+            self._cfg_cache[guild_id] = cfg
+        return dict(cfg)
 
     async def set_staff_role(self, guild_id: int, role_id: int):
         async with self.pool.acquire() as c:
-            await c.execute("""
+            row = await c.fetchrow("""
                 INSERT INTO config(guild_id, staff_role_id)
                 VALUES($1,$2)
                 ON CONFLICT (guild_id) DO UPDATE SET staff_role_id=EXCLUDED.staff_role_id
+                RETURNING *
             """, guild_id, role_id)
+        self._cfg_store(guild_id, row)
 
     async def set_category(self, guild_id: int, category_id: int):
         async with self.pool.acquire() as c:
-            await c.execute("""
+            row = await c.fetchrow("""
                 INSERT INTO config(guild_id, category_id)
                 VALUES($1,$2)
                 ON CONFLICT (guild_id) DO UPDATE SET category_id=EXCLUDED.category_id
+                RETURNING *
             """, guild_id, category_id)
+        self._cfg_store(guild_id, row)
 
     # ---------- Bugs: canales y aviso fijado ----------
     async def set_bug_channels(self, guild_id: int, input_channel_id: int | None, log_channel_id: int | None):
-        async with self.pool.acquire() as c:
-            cur = await c.fetchrow("SELECT 1 FROM config WHERE guild_id=$1", guild_id)
-            if not cur:
-                await c.execute("INSERT INTO config(guild_id, bug_input_channel_id, bug_log_channel_id) VALUES($1,$2,$3)",
-                                guild_id, input_channel_id, log_channel_id)
-            else:
-                if input_channel_id is not None:
-                    await c.execute("UPDATE config SET bug_input_channel_id=$2 WHERE guild_id=$1", guild_id, input_channel_id)
-                if log_channel_id is not None:
-                    await c.execute("UPDATE config SET bug_log_channel_id=$2 WHERE guild_id=$1", guild_id, log_channel_id)
+        try:
+            async with self.pool.acquire() as c:
+                cur = await c.fetchrow("SELECT 1 FROM config WHERE guild_id=$1", guild_id)
+                if not cur:
+                    await c.execute("INSERT INTO config(guild_id, bug_input_channel_id, bug_log_channel_id) VALUES($1,$2,$3)",
+                                    guild_id, input_channel_id, log_channel_id)
+                else:
+                    if input_channel_id is not None:
+                        await c.execute("UPDATE config SET bug_input_channel_id=$2 WHERE guild_id=$1", guild_id, input_channel_id)
+                    if log_channel_id is not None:
+                        await c.execute("UPDATE config SET bug_log_channel_id=$2 WHERE guild_id=$1", guild_id, log_channel_id)
+        finally:
+            self._cfg_evict(guild_id)
 
     async def get_bug_channels(self, guild_id: int) -> dict:
         cfg = await self.get_config(guild_id)
@@ -239,20 +574,24 @@ class Database:
 
     async def set_bug_notice(self, guild_id: int, channel_id: int, message_id: int):
         async with self.pool.acquire() as c:
-            await c.execute("""
+            row = await c.fetchrow("""
                 INSERT INTO config(guild_id, bug_notice_channel_id, bug_notice_message_id)
                 VALUES($1,$2,$3)
                 ON CONFLICT (guild_id) DO UPDATE SET
                     bug_notice_channel_id=EXCLUDED.bug_notice_channel_id,
                     bug_notice_message_id=EXCLUDED.bug_notice_message_id
+                RETURNING *
             """, guild_id, channel_id, message_id)
+        self._cfg_store(guild_id, row)
 
     async def clear_bug_notice(self, guild_id: int):
         async with self.pool.acquire() as c:
-            await c.execute("""
+            row = await c.fetchrow("""
                 UPDATE config SET bug_notice_channel_id=NULL, bug_notice_message_id=NULL
                 WHERE guild_id=$1
+                RETURNING *
             """, guild_id)
+        self._cfg_store(guild_id, row)
 
     # ---------- Bugs: settings y ping ----------
     async def get_bug_settings(self, guild_id: int):
@@ -265,27 +604,32 @@ class Database:
         }
 
     async def set_bug_settings(self, guild_id: int, window_hours: int | None, mute_minutes: int | None):
-        async with self.pool.acquire() as c:
-            if window_hours is not None:
-                await c.execute("""
-                    INSERT INTO config(guild_id, bug_window_hours) VALUES($1,$2)
-                    ON CONFLICT (guild_id) DO UPDATE SET bug_window_hours=EXCLUDED.bug_window_hours
-                """, guild_id, int(window_hours))
-            if mute_minutes is not None:
-                await c.execute("""
-                    INSERT INTO config(guild_id, bug_mute_minutes) VALUES($1,$2)
-                    ON CONFLICT (guild_id) DO UPDATE SET bug_mute_minutes=EXCLUDED.bug_mute_minutes
-                """, guild_id, int(mute_minutes))
+        try:
+            async with self.pool.acquire() as c:
+                if window_hours is not None:
+                    await c.execute("""
+                        INSERT INTO config(guild_id, bug_window_hours) VALUES($1,$2)
+                        ON CONFLICT (guild_id) DO UPDATE SET bug_window_hours=EXCLUDED.bug_window_hours
+                    """, guild_id, int(window_hours))
+                if mute_minutes is not None:
+                    await c.execute("""
+                        INSERT INTO config(guild_id, bug_mute_minutes) VALUES($1,$2)
+                        ON CONFLICT (guild_id) DO UPDATE SET bug_mute_minutes=EXCLUDED.bug_mute_minutes
+                    """, guild_id, int(mute_minutes))
+        finally:
+            self._cfg_evict(guild_id)
 
     async def set_bug_ping_mode(self, guild_id: int, mode: str, role_id: int | None):
         async with self.pool.acquire() as c:
-            await c.execute("""
+            row = await c.fetchrow("""
                 INSERT INTO config(guild_id, bug_ping_mode, bug_ping_role_id)
                 VALUES($1,$2,$3)
                 ON CONFLICT (guild_id) DO UPDATE SET
                 bug_ping_mode=EXCLUDED.bug_ping_mode,
                 bug_ping_role_id=EXCLUDED.bug_ping_role_id
+                RETURNING *
             """, guild_id, mode, role_id)
+        self._cfg_store(guild_id, row)
 
     # ---------- Bugs: rate limiting ----------
     async def check_bug_rate(self, guild_id: int, user_id: int, window_hours: int):
@@ -318,6 +662,7 @@ class Database:
         try:
             async with self.pool.acquire() as c:
                 await c.execute("INSERT INTO prizes(name, description, weight) VALUES($1,$2,$3)", name, description, weight)
+            self._invalidate_prizes()
             return {"ok": True, "prize": {"name": name, "description": description, "weight": weight}}
         except asyncpg.UniqueViolationError:
             return {"ok": False, "reason": "duplicate"}
@@ -330,80 +675,242 @@ class Database:
     async def remove_prize(self, name: str):
         async with self.pool.acquire() as c:
             res = await c.execute("DELETE FROM prizes WHERE name=$1", name)
-            return {"ok": res.endswith("DELETE 1")}
+        self._invalidate_prizes()
+        return {"ok": res.endswith("DELETE 1")}
 
     async def _get_prize(self, name: str):
         async with self.pool.acquire() as c:
             r = await c.fetchrow("SELECT name, description, weight FROM prizes WHERE name=$1", name)
             return dict(r) if r else None
 
-    async def _choose_random_prize(self):
-        async with self.pool.acquire() as c:
-            rows = await c.fetch("SELECT name, description, weight FROM prizes")
-        items = [dict(r) for r in rows]
-        if not items:
-            return None
-        weights = [max(1, int(p.get("weight", 1))) for p in items]
-        return random.choices(items, weights=weights, k=1)[0]
+    def _invalidate_prizes(self):
+        self._prize_gen += 1
+        self._prize_sampler = None
+
+    async def _get_prize_sampler(self) -> AliasSampler:
+        sampler = self._prize_sampler
+        if sampler is not None:
+            return sampler
+        gen = self._prize_gen
+        fut = self._prize_loading.get(gen)
+        if fut:  # una sola carga por versión del set de premios aunque lleguen muchos canjes a la vez
+            return await asyncio.shield(fut)
+        fut = self._prize_loading[gen] = asyncio.get_running_loop().create_future()
+        try:
+            async with self.pool.acquire() as c:
+                rows = await c.fetch("SELECT name, description, weight FROM prizes")
+            items = [dict(r) for r in rows]
+            sampler = AliasSampler(items, [max(1, int(p.get("weight") or 1)) for p in items])
+            self.prize_sampler_builds += 1
+            if gen == self._prize_gen:
+                self._prize_sampler = sampler
+            fut.set_result(sampler)
+            return sampler
+        except Exception as e:
+            fut.set_exception(e); fut.exception()
+            raise
+        finally:
+            self._prize_loading.pop(gen, None)
+
+    # ---------- Keys: filtro de Bloom ----------
+    async def load_key_filter(self):
+        """Construye el filtro recorriendo la tabla keys con un cursor (sin cargarla entera en memoria)."""
+        # lo que aún no confirmó no lo verá el cursor: entra por la lista de pendientes
+        self._key_filter_pending = [code for codes in self._key_inflight for code in codes]
+        try:
+            async with self.pool.acquire() as c:
+                n = await c.fetchval("SELECT COUNT(*) FROM keys")
+                bf = BloomFilter(max(KEY_FILTER_MIN_CAPACITY, 2 * int(n or 0)))
+                async with c.transaction():
+                    async for r in c.cursor("SELECT code FROM keys", prefetch=10_000):
+                        bf.add(r["code"])
+            for code in self._key_filter_pending:
+                bf.add(code)
+            self._key_filter = bf
+            self.key_filter_stats["builds"] += 1
+        finally:
+            self._key_filter_pending = None
+
+    def _remember_codes(self, codes):
+        bf = self._key_filter
+        if bf is None:
+            return
+        for code in codes:
+            bf.add(code)
+        if self._key_filter_pending is not None:
+            self._key_filter_pending.extend(codes)
+        # pasado de capacidad el ratio de falsos positivos sube: reconstruir más grande en segundo plano
+        if bf.count > bf.capacity and (self._key_filter_task is None or self._key_filter_task.done()):
+            self._key_filter_task = asyncio.create_task(self.load_key_filter())
+            self._key_filter_task.add_done_callback(self._key_filter_rebuilt)
+
+    def _key_filter_rebuilt(self, task: asyncio.Task):
+        # si falla se sigue con el filtro anterior (sobrecargado, pero sin falsos negativos)
+        if not task.cancelled() and task.exception() is not None:
+            self.key_filter_stats["build_errors"] += 1
+            print("[db] no pude reconstruir el filtro de keys:", task.exception())
+
+    def key_filter_info(self) -> dict:
+        bf = self._key_filter
+        if bf is None:
+            return {"enabled": False, **self.key_filter_stats}
+        return {"enabled": True, "capacity": bf.capacity, "count": bf.count, "bits": bf.m, "hashes": bf.k,
+                "bytes": len(bf.bits), "target_fp_rate": bf.fp_rate, "estimated_fp_rate": bf.estimated_fp_rate(),
+                **self.key_filter_stats}
 
     # ---------- Keys ----------
-    async def create_keys(self, amount: int, mode: str, prize: str | None, created_by: int | None, expires_days: int | None):
+    async def _insert_new_codes(self, c, amount: int, mode: str, prize: str | None, exp_at, inflight: set) -> List[str]:
+        """Inserta `amount` códigos en una sentencia; solo se regeneran los que chocan con existentes."""
+        done: List[str] = []
+        while len(done) < amount:
+            batch = set()
+            while len(batch) < amount - len(done):
+                batch.add(codegen())
+            # al filtro antes del INSERT: un canje inmediato nunca debe ver un falso not_found
+            inflight.update(batch)
+            self._remember_codes(batch)
+            rows = await c.fetch("""
+                INSERT INTO keys(code, mode, prize_name, expires_at, used)
+                SELECT x, $2, $3, $4, FALSE FROM unnest($1::text[]) AS x
+                ON CONFLICT (code) DO NOTHING
+                RETURNING code
+            """, list(batch), mode, prize, exp_at)
+            done.extend(r["code"] for r in rows)
+        return done
+
+    async def validate_key_request(self, amount: int, mode: str, prize: str | None):
+        """Normaliza el modo y valida la petición; devuelve (modo, motivo_error|None)."""
         if mode not in ("random", "fixed"):
             mode = "random"
+        if not 1 <= int(amount) <= MAX_KEYS_PER_BATCH:
+            return mode, "bad_amount"
         if mode == "fixed":
             if not prize:
-                return {"ok": False, "reason": "prize_required"}
+                return mode, "prize_required"
             p = await self._get_prize(prize)
             if not p:
-                return {"ok": False, "reason": "prize_not_found"}
+                return mode, "prize_not_found"
+        return mode, None
+
+    async def create_keys(self, amount: int, mode: str, prize: str | None, created_by: int | None, expires_days: int | None):
+        mode, reason = await self.validate_key_request(amount, mode, prize)
+        if reason:
+            return {"ok": False, "reason": reason}
 
         codes = []
         exp_at = None
         if expires_days:
             exp_at = now() + timedelta(days=int(expires_days))
-        async with self.pool.acquire() as c:
-            async with c.transaction():
-                for _ in range(amount):
-                    while True:
-                        code = codegen()
-                        exists = await c.fetchval("SELECT 1 FROM keys WHERE code=$1", code)
-                        if not exists:
-                            break
-                    await c.execute(
-                        "INSERT INTO keys(code, mode, prize_name, expires_at, used) VALUES($1,$2,$3,$4,FALSE)",
-                        code, mode, prize if mode == "fixed" else None, exp_at
-                    )
-                    codes.append(code)
+        inflight = set()
+        self._key_inflight.append(inflight)
+        try:
+            async with self.pool.acquire() as c:
+                async with c.transaction():
+                    while len(codes) < amount:
+                        n = min(KEY_INSERT_CHUNK, amount - len(codes))
+                        codes.extend(await self._insert_new_codes(c, n, mode, prize if mode == "fixed" else None, exp_at, inflight))
+        finally:
+            self._key_inflight.remove(inflight)
         return {"ok": True, "codes": codes, "mode": mode, "prize": prize, "expires_days": expires_days}
 
+    async def create_keys_iter(self, amount: int, mode: str, prize: str | None, expires_days: int | None, chunk: int = 1000):
+        """Igual que create_keys pero entrega los códigos por tandas ya confirmadas (cada tanda en su transacción).
+        Validar antes con validate_key_request: aquí el modo ya viene normalizado."""
+        exp_at = now() + timedelta(days=int(expires_days)) if expires_days else None
+        left = int(amount)
+        while left > 0:
+            n = min(chunk, left)
+            inflight = set()
+            self._key_inflight.append(inflight)
+            try:
+                async with self.pool.acquire() as c:
+                    codes = await self._insert_new_codes(c, n, mode, prize if mode == "fixed" else None, exp_at, inflight)
+            finally:
+                self._key_inflight.remove(inflight)
+            left -= len(codes)
+            yield codes
+
     async def check_key(self, code: str, user_id: int | None):
+        return (await self.check_keys([code], user_id))[0]
+
+    async def check_keys(self, codes: List[str], user_id: int | None) -> List[dict]:
+        """Canjea varias keys en un solo viaje; devuelve un resultado por código, en el mismo orden."""
+        # los códigos que el filtro descarta se responden not_found sin tocar la DB
+        uniq = list(dict.fromkeys(codes))
+        results = {code: {"ok": False, "reason": "not_found"} for code in uniq}
+        bf = self._key_filter
+        if bf is not None:
+            known = [code for code in uniq if code in bf]
+            self.key_filter_stats["rejected"] += len(uniq) - len(known)
+            self.key_filter_stats["passed"] += len(known)
+            uniq = known
+        if uniq:
+            results.update(await self._redeem_known(uniq, user_id))
+        out, seen = [], set()
+        for code in codes:
+            # un código repetido en la misma tanda solo puede canjearse una vez
+            out.append(results[code] if code not in seen else {"ok": False, "reason": "used"})
+            seen.add(code)
+        return out
+
+    async def _redeem_known(self, uniq: List[str], user_id: int | None) -> Dict[str, dict]:
+        # El UPDATE condicional decide quién gana si dos canjean a la vez. Los premios random se sortean
+        # antes en memoria, todos de la misma foto del sampler; la sentencia solo los usa para keys random.
+        sampler = await self._get_prize_sampler()
+        drawn = [sampler.draw()["name"] if len(sampler) else None for _ in uniq]
         async with self.pool.acquire() as c:
-            row = await c.fetchrow("SELECT * FROM keys WHERE code=$1", code)
-            if not row:
-                return {"ok": False, "reason": "not_found"}
-            d = dict(row)
-            if d["used"]:
-                return {"ok": False, "reason": "used"}
-            if d["expires_at"] and d["expires_at"] < now():
-                return {"ok": False, "reason": "expired"}
-            if d["mode"] == "fixed":
-                prize = await self._get_prize(d["prize_name"])
-            else:
-                prize = await self._choose_random_prize()
-                if not prize:
-                    return {"ok": False, "reason": "no_prizes"}
-            if not prize:
-                return {"ok": False, "reason": "prize_missing"}
-            await c.execute("UPDATE keys SET used=TRUE, used_by=$1, used_at=$2 WHERE code=$3", user_id, now(), code)
-            return {"ok": True, "mode": d["mode"], "prize": prize, "code": code}
+            rows = await c.fetch("""
+                WITH req AS (
+                    SELECT r.code, r.drawn, r.ord FROM unnest($1::text[], $3::text[]) WITH ORDINALITY AS r(code, drawn, ord)
+                ), k AS (
+                    SELECT req.ord, req.code, keys.mode, keys.used, keys.expires_at,
+                           CASE WHEN keys.mode = 'fixed' THEN keys.prize_name ELSE req.drawn END AS want
+                    FROM req JOIN keys ON keys.code = req.code
+                ), upd AS (
+                    UPDATE keys SET used=TRUE, used_by=$2, used_at=NOW()
+                    FROM k JOIN prizes p ON p.name = k.want
+                    WHERE keys.code = k.code AND keys.used=FALSE AND (keys.expires_at IS NULL OR keys.expires_at > NOW())
+                    RETURNING keys.code
+                )
+                SELECT k.ord, k.mode, k.used, (k.expires_at IS NOT NULL AND k.expires_at <= NOW()) AS expired,
+                       p.name, p.description, p.weight, (upd.code IS NOT NULL) AS redeemed
+                FROM k LEFT JOIN prizes p ON p.name = k.want LEFT JOIN upd ON upd.code = k.code
+            """, uniq, user_id, drawn)
+        by_ord = {int(r["ord"]): r for r in rows}
+        return {code: self._redeem_result(code, by_ord.get(i)) for i, code in enumerate(uniq, start=1)}
+
+    @staticmethod
+    def _redeem_result(code: str, r) -> dict:
+        if not r:
+            return {"ok": False, "reason": "not_found"}
+        if r["redeemed"]:
+            prize = {"name": r["name"], "description": r["description"], "weight": r["weight"]}
+            return {"ok": True, "mode": r["mode"], "prize": prize, "code": code}
+        if r["used"]:
+            return {"ok": False, "reason": "used"}
+        if r["expired"]:
+            return {"ok": False, "reason": "expired"}
+        if r["name"] is None:
+            return {"ok": False, "reason": "prize_missing" if r["mode"] == "fixed" else "no_prizes"}
+        # la key estaba libre en nuestra foto pero otro canje concurrente la marcó primero
+        return {"ok": False, "reason": "used"}
 
     # ---------- Tickets ----------
-    async def create_ticket(self, guild_id: int, opener_id: int, kind: str, channel_id: int):
+    async def warm_ticket_index(self):
+        self._open_tickets = {int(t["channel_id"]): int(t["id"]) for t in await self.list_open_tickets()}
+
+    def ticket_id_for_channel(self, channel_id: int) -> Optional[int]:
+        return self._open_tickets.get(channel_id)
+
+    async def create_ticket(self, guild_id: int, opener_id: int, kind: str, channel_id: int) -> int:
         async with self.pool.acquire() as c:
-            await c.execute("""
+            tid = await c.fetchval("""
                 INSERT INTO tickets(guild_id, opener_id, kind, channel_id, status, created_at, last_activity)
                 VALUES($1,$2,$3,$4,'open',NOW(),NOW())
+                RETURNING id
             """, guild_id, opener_id, kind, channel_id)
+        self._open_tickets[channel_id] = int(tid)
+        return int(tid)
 
     async def fetch_ticket_by_channel(self, channel_id: int):
         async with self.pool.acquire() as c:
@@ -411,24 +918,54 @@ class Database:
             return dict(r) if r else None
 
     async def close_ticket_by_channel(self, channel_id: int, closed_by: int, reason: str):
+        # sacar el canal del índice antes de volcar: así no entra nada más al buffer para este ticket
+        tid = self._open_tickets.pop(channel_id, None)
+        if tid is not None:
+            self._tauthors.pop(tid, None)
+        try:
+            if tid is not None:
+                await self.flush_ticket_messages(tid)
+            async with self.pool.acquire() as c:
+                t = await c.fetchrow("SELECT * FROM tickets WHERE channel_id=$1", channel_id)
+                if not t or t["status"] != "open":
+                    return None
+                tid = t["id"]
+                t2 = await c.fetchrow("""
+                    UPDATE tickets SET status='closed', closed_at=NOW(), close_reason=$2, closed_by=$3
+                    WHERE id=$1
+                    RETURNING *
+                """, tid, reason, closed_by)
+                return dict(t2)
+        except Exception:
+            if tid is not None:
+                self._open_tickets.setdefault(channel_id, int(tid))
+            raise
+
+    async def iter_ticket_messages(self, ticket_id: int, page: int = TICKET_MSG_PAGE):
+        """Mensajes del ticket en orden, por páginas de Records desde un cursor del servidor."""
         async with self.pool.acquire() as c:
-            t = await c.fetchrow("SELECT * FROM tickets WHERE channel_id=$1", channel_id)
-            if not t or t["status"] != "open":
-                return None
-            tid = t["id"]
-            await c.execute("""
-                UPDATE tickets SET status='closed', closed_at=NOW(), close_reason=$2, closed_by=$3
-                WHERE id=$1
-            """, tid, reason, closed_by)
-            msgs = await c.fetch("SELECT author_id, content, attachments, created_at FROM ticket_messages WHERE ticket_id=$1 ORDER BY created_at ASC", tid)
-            t2 = await c.fetchrow("SELECT * FROM tickets WHERE id=$1", tid)
-            return (dict(t2), [dict(x) for x in msgs])
+            async with c.transaction():
+                cur = await c.cursor("""
+                    SELECT author_id, content, attachments, created_at FROM ticket_messages
+                    WHERE ticket_id=$1 ORDER BY created_at ASC, id ASC
+                """, ticket_id)
+                while True:
+                    rows = await cur.fetch(page)
+                    if rows: yield rows
+                    if len(rows) < page: break
 
     async def reopen_ticket_by_channel(self, channel_id: int):
         async with self.pool.acquire() as c:
-            await c.execute("UPDATE tickets SET status='open', closed_at=NULL, close_reason=NULL WHERE channel_id=$1", channel_id)
-            r = await c.fetchrow("SELECT * FROM tickets WHERE channel_id=$1", channel_id)
-            return dict(r) if r else None
+            r = await c.fetchrow("""
+                UPDATE tickets SET status='open', closed_at=NULL, close_reason=NULL,
+                       last_activity=NOW(), warned_30=FALSE, warned_10=FALSE
+                WHERE channel_id=$1
+                RETURNING *
+            """, channel_id)
+            if not r:
+                return None
+            self._open_tickets[channel_id] = int(r["id"])
+            return dict(r)
 
     async def set_claim(self, channel_id: int, claimed_by: int | None):
         async with self.pool.acquire() as c:
@@ -442,17 +979,115 @@ class Database:
         async with self.pool.acquire() as c:
             await c.execute("UPDATE tickets SET payment_method=$2 WHERE channel_id=$1", channel_id, method)
 
-    async def log_ticket_message(self, channel_id: int, author_id: int, content: str, attachments: List[str]):
-        async with self.pool.acquire() as c:
-            t = await c.fetchrow("SELECT id FROM tickets WHERE channel_id=$1", channel_id)
-            if not t:
-                return
-            tid = t["id"]
-            await c.execute("""
-                INSERT INTO ticket_messages(ticket_id, channel_id, author_id, content, attachments, created_at)
-                VALUES($1,$2,$3,$4,$5,NOW())
-            """, tid, channel_id, author_id, content, attachments)
-            await c.execute("UPDATE tickets SET last_activity=NOW() WHERE id=$1", tid)
+    async def log_ticket_message(self, channel_id: int, author_id: int, content: str, attachments: List[str],
+                                 author: tuple | None = None):
+        """`author` = (nombre visible, avatar, staff) del autor en este momento; se guarda una vez por ticket y autor."""
+        tid = self._open_tickets.get(channel_id)
+        if tid is None:
+            return
+        self._tmsg_buf.append((tid, channel_id, author_id, content, attachments, now()))
+        if author is not None:
+            known = self._tauthors.setdefault(tid, {})
+            if known.get(author_id) != author:
+                known[author_id] = author
+                self._tauthor_buf[(tid, author_id)] = author
+        n = len(self._tmsg_buf)
+        if n >= self.tmsg_max_rows:
+            await self.flush_ticket_messages()
+        elif n >= self.tmsg_flush_rows and (self._tmsg_task is None or self._tmsg_task.done()):
+            self._tmsg_task = asyncio.create_task(self._flush_ticket_messages_quiet())
+
+    async def flush_ticket_messages(self, ticket_id: int | None = None) -> int:
+        """Vuelca el buffer (o solo las filas de un ticket) con COPY y actualiza last_activity una vez por ticket."""
+        async with self._tmsg_lock:
+            if ticket_id is None:
+                rows, self._tmsg_buf = self._tmsg_buf, []
+            else:
+                rows = [r for r in self._tmsg_buf if r[0] == ticket_id]
+                if rows:
+                    self._tmsg_buf = [r for r in self._tmsg_buf if r[0] != ticket_id]
+            if ticket_id is None:
+                authors, self._tauthor_buf = self._tauthor_buf, {}
+            else:
+                authors = {k: self._tauthor_buf.pop(k) for k in [k for k in self._tauthor_buf if k[0] == ticket_id]}
+            if not rows and not authors:
+                return 0
+            t0 = time.perf_counter()
+            author_items = list(authors.items())
+            done = [0, 0]   # filas / snapshots ya resueltos (escritos o descartados): siempre un prefijo de la lista
+            try:
+                try:
+                    async with self.pool.acquire() as c:
+                        async with c.transaction():
+                            if rows: await self._copy_ticket_rows(c, rows)
+                            if author_items: await self._upsert_ticket_authors(c, author_items)
+                    done = [len(rows), len(author_items)]
+                except ROW_ERRORS:
+                    # alguna fila no entra en Postgres: aislarla partiendo el lote para no bloquear a las demás
+                    bad = await self._write_isolating(rows, self._copy_ticket_rows, done, 0)
+                    bad += await self._write_isolating(author_items, self._upsert_ticket_authors, done, 1)
+                    self.tmsg_stats["rejected"] += bad
+                    print(f"[db] ticket_messages: {bad} filas rechazadas y descartadas")
+            except Exception:
+                for k, v in author_items[done[1]:]:  # un snapshot más nuevo encolado mientras tanto gana
+                    self._tauthor_buf.setdefault(k, v)
+                # devolver las filas al frente sin pasar del tope; lo que no cabe se pierde
+                rest = rows[done[0]:]
+                keep = max(0, self.tmsg_max_rows - len(self._tmsg_buf))
+                self.tmsg_stats["errors"] += 1
+                self.tmsg_stats["dropped"] += max(0, len(rest) - keep)
+                if keep and rest:
+                    self._tmsg_buf[:0] = rest[-keep:]
+                raise
+            ms = (time.perf_counter() - t0) * 1000
+            st = self.tmsg_stats
+            st["flushes"] += 1; st["rows"] += len(rows); st["last_ms"] = ms; st["total_ms"] += ms
+            st["max_ms"] = max(st["max_ms"], ms)
+            return len(rows)
+
+    @staticmethod
+    async def _copy_ticket_rows(c, rows: List[tuple]):
+        last: Dict[int, datetime] = {}
+        for r in rows:
+            last[r[0]] = r[5]
+        await c.copy_records_to_table("ticket_messages", records=rows, columns=TICKET_MSG_COLUMNS)
+        await c.execute("""
+            UPDATE tickets t SET last_activity=x.ts
+            FROM unnest($1::bigint[], $2::timestamptz[]) AS x(id, ts)
+            WHERE t.id=x.id
+        """, list(last.keys()), list(last.values()))
+
+    @staticmethod
+    async def _upsert_ticket_authors(c, items: List[tuple]):
+        await c.execute("""
+            INSERT INTO ticket_authors(ticket_id, author_id, display_name, avatar_url, is_staff)
+            SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::bool[])
+            ON CONFLICT (ticket_id, author_id) DO UPDATE
+              SET display_name=EXCLUDED.display_name, avatar_url=EXCLUDED.avatar_url,
+                  is_staff=EXCLUDED.is_staff, updated_at=NOW()
+        """, [k[0] for k, _ in items], [k[1] for k, _ in items], *[[v[i] for _, v in items] for i in range(3)])
+
+    async def _write_isolating(self, items: List, write, done: List[int], slot: int) -> int:
+        """Escribe `items` en transacciones cada vez más pequeñas hasta aislar las filas rechazadas; devuelve cuántas se descartan."""
+        if not items:
+            return 0
+        try:
+            async with self.pool.acquire() as c:
+                async with c.transaction():
+                    await write(c, items)
+        except ROW_ERRORS:
+            if len(items) > 1:
+                mid = len(items) // 2
+                return (await self._write_isolating(items[:mid], write, done, slot)
+                        + await self._write_isolating(items[mid:], write, done, slot))
+            done[slot] += 1
+            return 1
+        done[slot] += len(items)
+        return 0
+
+    async def _flush_ticket_messages_quiet(self):
+        try: await self.flush_ticket_messages()
+        except Exception: pass
 
     async def list_open_tickets(self):
         async with self.pool.acquire() as c:
@@ -476,6 +1111,58 @@ class Database:
             v = await c.fetchval("SELECT COUNT(*) FROM tickets WHERE opener_id=$1", user_id)
             return int(v or 0)
 
+    # ---------- Tickets: archivo de transcripciones ----------
+    @staticmethod
+    def _pack_blobs(*datas: bytes) -> list:
+        return [(hashlib.sha256(b).hexdigest(), gzip.compress(b, TRANSCRIPT_GZIP_LEVEL), len(b)) for b in datas]
+
+    async def archive_transcript(self, ticket_id: int, guild_id: int, txt: bytes, html: bytes) -> Dict[str, str]:
+        blobs = await asyncio.to_thread(self._pack_blobs, txt, html)  # gzip es CPU: fuera del loop
+        async with self.pool.acquire() as c:
+            async with c.transaction():
+                await c.execute("""
+                    INSERT INTO transcript_blobs(sha256, gz, size)
+                    SELECT * FROM unnest($1::text[], $2::bytea[], $3::int[])
+                    ON CONFLICT (sha256) DO NOTHING
+                """, *[list(col) for col in zip(*blobs)])
+                await c.execute("""
+                    INSERT INTO ticket_transcripts(ticket_id, guild_id, txt_sha256, html_sha256) VALUES($1,$2,$3,$4)
+                    ON CONFLICT (ticket_id) DO UPDATE
+                      SET txt_sha256=EXCLUDED.txt_sha256, html_sha256=EXCLUDED.html_sha256, archived_at=NOW()
+                """, ticket_id, guild_id, blobs[0][0], blobs[1][0])
+        self.archive_stats["archived"] += 1
+        self.archive_stats["raw_bytes"] += blobs[0][2] + blobs[1][2]
+        self.archive_stats["gz_bytes"] += len(blobs[0][1]) + len(blobs[1][1])
+        return {"txt": blobs[0][0], "html": blobs[1][0]}
+
+    async def fetch_transcript(self, ticket_id: int) -> Optional[Dict]:
+        """Transcripción archivada tal cual se guardó: {"guild_id", "archived_at", "txt"/"html": {"sha256", "gz", "size"}}."""
+        async with self.pool.acquire() as c:
+            r = await c.fetchrow("""
+                SELECT t.guild_id, t.archived_at,
+                       bt.sha256 AS txt_sha256, bt.gz AS txt_gz, bt.size AS txt_size,
+                       bh.sha256 AS html_sha256, bh.gz AS html_gz, bh.size AS html_size
+                FROM ticket_transcripts t
+                JOIN transcript_blobs bt ON bt.sha256 = t.txt_sha256
+                JOIN transcript_blobs bh ON bh.sha256 = t.html_sha256
+                WHERE t.ticket_id=$1
+            """, ticket_id)
+        if not r:
+            return None
+        return {"guild_id": r["guild_id"], "archived_at": r["archived_at"],
+                **{f: {"sha256": r[f"{f}_sha256"], "gz": bytes(r[f"{f}_gz"]), "size": r[f"{f}_size"]} for f in ("txt", "html")}}
+
+    async def ticket_authors(self, ticket_id: int) -> Dict[int, tuple]:
+        """author_id -> (nombre visible, avatar, staff) tal como se registró en el ticket."""
+        async with self.pool.acquire() as c:
+            rows = await c.fetch("SELECT author_id, display_name, avatar_url, is_staff FROM ticket_authors WHERE ticket_id=$1", ticket_id)
+        return {int(r["author_id"]): (r["display_name"], r["avatar_url"] or "", bool(r["is_staff"])) for r in rows}
+
+    async def fetch_ticket(self, ticket_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as c:
+            r = await c.fetchrow("SELECT * FROM tickets WHERE id=$1", ticket_id)
+            return dict(r) if r else None
+
     # ---------- Tickets: roles permitidos ----------
     async def add_allowed_role(self, guild_id: int, role_id: int):
         async with self.pool.acquire() as c:
@@ -558,15 +1245,34 @@ class Database:
     async def antiping_add(self, guild_id: int, user_id: int):
         async with self.pool.acquire() as c:
             await c.execute("INSERT INTO antiping_targets(guild_id,user_id) VALUES($1,$2) ON CONFLICT DO NOTHING", guild_id, user_id)
+        self._antiping_gen += 1
+        if guild_id in self._antiping:
+            self._antiping[guild_id] = self._antiping[guild_id] | {user_id}
 
     async def antiping_remove(self, guild_id: int, user_id: int):
         async with self.pool.acquire() as c:
             await c.execute("DELETE FROM antiping_targets WHERE guild_id=$1 AND user_id=$2", guild_id, user_id)
-
-    async def antiping_list(self, guild_id: int) -> List[int]:
+        self._antiping_gen += 1
+        if guild_id in self._antiping:
+            self._antiping[guild_id] = self._antiping[guild_id] - {user_id}
+
+    async def antiping_protected(self, guild_id: int) -> frozenset:
+        """Usuarios protegidos del guild; solo consulta la DB la primera vez."""
+        ids = self._antiping.get(guild_id)
+        if ids is not None:
+            return ids
+        gen = self._antiping_gen
         async with self.pool.acquire() as c:
             rows = await c.fetch("SELECT user_id FROM antiping_targets WHERE guild_id=$1", guild_id)
-            return [int(r["user_id"]) for r in rows]
+        self.antiping_loads += 1
+        ids = frozenset(int(r["user_id"]) for r in rows)
+        # si hubo add/remove mientras leíamos, no fijar una foto vieja
+        if gen == self._antiping_gen:
+            self._antiping.setdefault(guild_id, ids)
+        return ids
+
+    async def antiping_list(self, guild_id: int) -> List[int]:
+        return sorted(await self.antiping_protected(guild_id))
 
     async def antiping_get_settings(self, guild_id: int):
         cfg = await self.get_config(guild_id)
@@ -577,19 +1283,22 @@ class Database:
         }
 
     async def antiping_set_settings(self, guild_id: int, threshold: int | None, timeout_minutes: int | None, window_hours: int | None):
-        async with self.pool.acquire() as c:
-            if threshold is not None:
-                await c.execute("""INSERT INTO config(guild_id, antiping_threshold) VALUES($1,$2)
-                                   ON CONFLICT (guild_id) DO UPDATE SET antiping_threshold=EXCLUDED.antiping_threshold""",
-                                guild_id, int(threshold))
-            if timeout_minutes is not None:
-                await c.execute("""INSERT INTO config(guild_id, antiping_timeout_minutes) VALUES($1,$2)
-                                   ON CONFLICT (guild_id) DO UPDATE SET antiping_timeout_minutes=EXCLUDED.antiping_timeout_minutes""",
-                                guild_id, int(timeout_minutes))
-            if window_hours is not None:
-                await c.execute("""INSERT INTO config(guild_id, antiping_window_hours) VALUES($1,$2)
-                                   ON CONFLICT (guild_id) DO UPDATE SET antiping_window_hours=EXCLUDED.antiping_window_hours""",
-                                guild_id, int(window_hours))
+        try:
+            async with self.pool.acquire() as c:
+                if threshold is not None:
+                    await c.execute("""INSERT INTO config(guild_id, antiping_threshold) VALUES($1,$2)
+                                       ON CONFLICT (guild_id) DO UPDATE SET antiping_threshold=EXCLUDED.antiping_threshold""",
+                                    guild_id, int(threshold))
+                if timeout_minutes is not None:
+                    await c.execute("""INSERT INTO config(guild_id, antiping_timeout_minutes) VALUES($1,$2)
+                                       ON CONFLICT (guild_id) DO UPDATE SET antiping_timeout_minutes=EXCLUDED.antiping_timeout_minutes""",
+                                    guild_id, int(timeout_minutes))
+                if window_hours is not None:
+                    await c.execute("""INSERT INTO config(guild_id, antiping_window_hours) VALUES($1,$2)
+                                       ON CONFLICT (guild_id) DO UPDATE SET antiping_window_hours=EXCLUDED.antiping_window_hours""",
+                                    guild_id, int(window_hours))
+        finally:
+            self._cfg_evict(guild_id)
 
     async def antiping_record(self, guild_id: int, offender_id: int, window_hours: int, threshold: int):
         """Devuelve 'warn' o 'mute' según contador/ventana."""
@@ -623,57 +1332,187 @@ class Database:
     async def giveaway_set_message(self, giveaway_id: int, message_id: int):
         async with self.pool.acquire() as c:
             await c.execute("UPDATE giveaways SET message_id=$2 WHERE id=$1", giveaway_id, message_id)
+        self._gw_msg[message_id] = giveaway_id
 
-    async def giveaway_enter(self, giveaway_id: int, user_id: int) -> bool:
-        async with self.pool.acquire() as c:
-            status = await c.fetchval("SELECT status FROM giveaways WHERE id=$1", giveaway_id)
+    async def giveaway_id_for_message(self, message_id: int) -> Optional[int]:
+        gid = self._gw_msg.get(message_id)
+        if gid is None:
+            async with self.pool.acquire() as c:
+                gid = await c.fetchval("SELECT id FROM giveaways WHERE message_id=$1", message_id)
+            if gid is not None:
+                gid = self._gw_msg[message_id] = int(gid)
+        return gid
+
+    async def _gw_state(self, giveaway_id: int) -> dict:
+        st = self._gw.get(giveaway_id)
+        if st is not None:
+            return st
+        fut = self._gw_loading.get(giveaway_id)
+        if fut:  # una sola carga aunque lleguen mil clics a la vez
+            return await asyncio.shield(fut)
+        fut = self._gw_loading[giveaway_id] = asyncio.get_running_loop().create_future()
+        try:
+            async with self.pool.acquire() as c:
+                status = await c.fetchval("SELECT status FROM giveaways WHERE id=$1", giveaway_id)
+                users = set()
+                if status == "running":
+                    users = {int(r["user_id"]) for r in await c.fetch("SELECT user_id FROM giveaway_entries WHERE giveaway_id=$1", giveaway_id)}
+            st = self._gw.setdefault(giveaway_id, {"status": status, "users": users})
+            self.gw_stats["loads"] += 1
+            fut.set_result(st)
+            return st
+        except Exception as e:
+            fut.set_exception(e); fut.exception()
+            raise
+        finally:
+            self._gw_loading.pop(giveaway_id, None)
+
+    def giveaway_cache_status(self, giveaway_id: int, status: str):
+        """Actualiza el estado en caché (fin, cancelación o cambio visto por NOTIFY)."""
+        st = self._gw.get(giveaway_id)
+        if st is not None:
+            st["status"] = status
             if status != "running":
-                return False
+                st["users"] = set()
+
+    async def giveaway_enter(self, giveaway_id: int, user_id: int) -> bool:
+        """Alta en memoria (responde al instante); la fila se inserta en el próximo volcado por lote."""
+        st = await self._gw_state(giveaway_id)
+        if st["status"] != "running":
+            self.gw_stats["rejected"] += 1
+            return False
+        if user_id in st["users"]:
+            self.gw_stats["duplicates"] += 1
+            return False
+        st["users"].add(user_id)
+        self._gw_buf.append((giveaway_id, user_id, now()))
+        self.gw_stats["entries"] += 1
+        if len(self._gw_buf) >= self.gw_flush_rows and (self._gw_task is None or self._gw_task.done()):
+            self._gw_task = asyncio.create_task(self._flush_giveaway_entries_quiet())
+        return True
+
+    def giveaway_entrant_count(self, giveaway_id: int) -> int | None:
+        st = self._gw.get(giveaway_id)
+        return len(st["users"]) if st is not None else None
+
+    async def flush_giveaway_entries(self, giveaway_id: int | None = None) -> int:
+        async with self._gw_lock:
+            if giveaway_id is None:
+                rows, self._gw_buf = self._gw_buf, []
+            else:
+                rows = [r for r in self._gw_buf if r[0] == giveaway_id]
+                if rows:
+                    self._gw_buf = [r for r in self._gw_buf if r[0] != giveaway_id]
+            if not rows:
+                return 0
             try:
-                await c.execute("INSERT INTO giveaway_entries(giveaway_id, user_id) VALUES($1,$2) ON CONFLICT DO NOTHING",
-                                giveaway_id, user_id)
-                return True
+                async with self.pool.acquire() as c:
+                    await c.execute("""
+                        INSERT INTO giveaway_entries(giveaway_id, user_id, joined_at)
+                        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::timestamptz[])
+                        ON CONFLICT DO NOTHING
+                    """, *[list(col) for col in zip(*rows)])
             except Exception:
-                return False
+                self.gw_stats["errors"] += 1
+                self._gw_buf[:0] = rows
+                raise
+            self.gw_stats["flushes"] += 1
+            self.gw_stats["rows"] += len(rows)
+            return len(rows)
+
+    async def _flush_giveaway_entries_quiet(self):
+        try: await self.flush_giveaway_entries()
+        except Exception: pass
 
     async def giveaway_list(self, guild_id: int) -> List[Dict]:
         async with self.pool.acquire() as c:
             rows = await c.fetch("SELECT * FROM giveaways WHERE guild_id=$1 ORDER BY created_at DESC", guild_id)
             return [dict(r) for r in rows]
 
-    async def giveaway_list_due(self) -> List[Dict]:
+    async def giveaway_by_message(self, guild_id: int, message_id: int) -> Optional[Dict]:
+        """Busca por el mensaje del anuncio (idx_giveaways_message)."""
         async with self.pool.acquire() as c:
-            rows = await c.fetch("""
-                SELECT * FROM giveaways
-                WHERE status='running' AND ends_at <= NOW()
-                ORDER BY ends_at ASC
-            """)
+            r = await c.fetchrow("SELECT * FROM giveaways WHERE message_id=$1 AND guild_id=$2", message_id, guild_id)
+            return dict(r) if r else None
+
+    async def giveaway_get(self, giveaway_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as c:
+            r = await c.fetchrow("SELECT * FROM giveaways WHERE id=$1", giveaway_id)
+            return dict(r) if r else None
+
+    async def giveaway_list_running(self) -> List[Dict]:
+        """id y fin de los giveaways en curso (recorre idx_giveaways_due)."""
+        async with self.pool.acquire() as c:
+            rows = await c.fetch("SELECT id, ends_at FROM giveaways WHERE status='running' ORDER BY ends_at ASC")
             return [dict(r) for r in rows]
 
     async def giveaway_end(self, giveaway_id: int) -> Dict:
+        # cerrar la puerta en memoria antes de volcar: así las últimas altas entran en el sorteo y no llegan más
+        st = self._gw.get(giveaway_id)
+        prev = st["status"] if st else None
+        if st: st["status"] = "ending"
+        try:
+            await self.flush_giveaway_entries(giveaway_id)
+            return await self._giveaway_draw(giveaway_id)
+        except Exception:
+            if st and st["status"] == "ending": st["status"] = prev
+            raise
+
+    async def _giveaway_pick(self, c, gw, rnd: int) -> List[int]:
+        """Elige hasta gw.winners participantes que no hayan ganado antes, dentro de la transacción de `c`.
+        El ORDER BY random() LIMIT lo resuelve Postgres con un top-N: aquí solo viajan los ganadores."""
+        rows = await c.fetch("""
+            SELECT e.user_id FROM giveaway_entries e
+            WHERE e.giveaway_id=$1
+              AND NOT EXISTS (SELECT 1 FROM giveaway_winners w WHERE w.giveaway_id=$1 AND w.user_id=e.user_id)
+            ORDER BY random() LIMIT $2
+        """, gw["id"], max(1, int(gw["winners"])))
+        sel = [int(r["user_id"]) for r in rows]
+        if sel:
+            await c.execute("""
+                INSERT INTO giveaway_winners(giveaway_id, user_id, round)
+                SELECT $1, u, $3 FROM unnest($2::bigint[]) AS u
+            """, gw["id"], sel, rnd)
+        self.gw_stats["winners"] += len(sel)
+        return sel
+
+    @staticmethod
+    def _giveaway_result(gw, sel: List[int]) -> Dict:
+        return {
+            "ok": True,
+            "id": int(gw["id"]),
+            "guild_id": int(gw["guild_id"]),
+            "channel_id": int(gw["channel_id"]),
+            "message_id": int(gw["message_id"]) if gw["message_id"] else None,
+            "prize": gw["prize"],
+            "winners": sel
+        }
+
+    async def _giveaway_draw(self, giveaway_id: int) -> Dict:
         async with self.pool.acquire() as c:
-            gw = await c.fetchrow("SELECT * FROM giveaways WHERE id=$1", giveaway_id)
-            if not gw or gw["status"] != "running":
-                return {"ok": False, "reason": "not_running"}
-            entries = await c.fetch("SELECT user_id FROM giveaway_entries WHERE giveaway_id=$1", giveaway_id)
-            pool = [int(r["user_id"]) for r in entries]
-            winners_count = max(1, int(gw["winners"]))
-            if len(pool) == 0:
-                sel = []
-            elif len(pool) <= winners_count:
-                sel = list(dict.fromkeys(pool))  # únicos
-            else:
-                sel = random.sample(pool, winners_count)
-            await c.execute("UPDATE giveaways SET status='ended' WHERE id=$1", giveaway_id)
-            return {
-                "ok": True,
-                "id": int(gw["id"]),
-                "guild_id": int(gw["guild_id"]),
-                "channel_id": int(gw["channel_id"]),
-                "message_id": int(gw["message_id"]) if gw["message_id"] else None,
-                "prize": gw["prize"],
-                "winners": sel
-            }
+            async with c.transaction():
+                # el UPDATE condicionado hace de cerrojo: solo un proceso pasa de running a ended y sortea
+                gw = await c.fetchrow("UPDATE giveaways SET status='ended' WHERE id=$1 AND status='running' RETURNING *", giveaway_id)
+                if not gw:
+                    status = await c.fetchval("SELECT status FROM giveaways WHERE id=$1", giveaway_id)
+                    self.giveaway_cache_status(giveaway_id, status or "missing")
+                    return {"ok": False, "reason": "not_running"}
+                sel = await self._giveaway_pick(c, gw, 0)
+        self.gw_stats["draws"] += 1
+        self.giveaway_cache_status(giveaway_id, "ended")
+        return self._giveaway_result(gw, sel)
+
+    async def giveaway_reroll(self, giveaway_id: int) -> Dict:
+        """Nueva ronda sobre un giveaway terminado, sin repetir ganadores anteriores."""
+        async with self.pool.acquire() as c:
+            async with c.transaction():
+                gw = await c.fetchrow("SELECT * FROM giveaways WHERE id=$1 FOR UPDATE", giveaway_id)
+                if not gw or gw["status"] != "ended":
+                    return {"ok": False, "reason": "not_ended"}
+                rnd = await c.fetchval("SELECT COALESCE(MAX(round), 0) + 1 FROM giveaway_winners WHERE giveaway_id=$1", giveaway_id)
+                sel = await self._giveaway_pick(c, gw, int(rnd))
+        self.gw_stats["rerolls"] += 1
+        return self._giveaway_result(gw, sel)
 
     # ---------- GOLD ACCOUNTS ----------
     async def gold_add(self, guild_id: int, admin_id: int, account_name: str, ugphone: str) -> dict:
@@ -709,3 +1548,43 @@ class Database:
                 WHERE guild_id=$1 AND admin_id=$2 AND account_name=$3
             """, guild_id, admin_id, account_name.strip())
             return res.endswith("DELETE 1")
+
+if __name__ == "__main__":
+    # benchmark del filtro de keys: python db.py [n_keys] [rtt_ms]
+    # La DB se simula: cada canje que pasa el filtro cuesta un viaje de rtt_ms y como mucho 5 van a la vez (pool max_size).
+    # Se canjea una tanda de códigos (mezcla de válidos e inventados) con y sin filtro.
+    import sys
+
+    n_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rtt = (float(sys.argv[2]) if len(sys.argv) > 2 else 20.0) / 1000
+    keys = {codegen() for _ in range(n_keys)}
+
+    t = time.perf_counter()
+    bf = BloomFilter(max(KEY_FILTER_MIN_CAPACITY, 2 * n_keys))
+    for k in keys: bf.add(k)
+    build_ms = (time.perf_counter() - t) * 1000
+    probes = [c for c in (codegen() for _ in range(200_000)) if c not in keys]
+    fp = sum(c in bf for c in probes) / len(probes)
+    print(f"filtro: {n_keys} keys  capacidad {bf.capacity}  {len(bf.bits) / 1024:.1f} KiB  k={bf.k}  "
+          f"construcción {build_ms:.0f} ms  falsos positivos {fp:.4%} (estimado {bf.estimated_fp_rate():.4%})")
+
+    async def bench(use_filter: bool, invalid_ratio: float, n_req: int = 1_000):
+        db = Database("")
+        db._key_filter = bf if use_filter else None
+        pool = asyncio.Semaphore(5)
+        valid = list(keys)
+        async def redeem_known(uniq, user_id):
+            async with pool:
+                await asyncio.sleep(rtt)
+            return {c: ({"ok": True} if c in keys else {"ok": False, "reason": "not_found"}) for c in uniq}
+        db._redeem_known = redeem_known
+        reqs = [codegen() if random.random() < invalid_ratio else random.choice(valid) for _ in range(n_req)]
+        t = time.perf_counter()
+        await asyncio.gather(*(db.check_keys([c], 1) for c in reqs))
+        return n_req / (time.perf_counter() - t), db.key_filter_stats["rejected"]
+
+    for ratio in (0.0, 0.5, 0.9, 0.99):
+        off, _ = asyncio.run(bench(False, ratio))
+        on, rejected = asyncio.run(bench(True, ratio))
+        print(f"inválidos {ratio:4.0%}: sin filtro {off:8.0f} canjes/s  con filtro {on:8.0f} canjes/s  "
+              f"(x{on / off:.1f}, {rejected} sin viaje a la DB)")
@@ -1,16 +1,20 @@
 # main.py
-import os, io, time, asyncio, random, html, base64, re, json
+import os, io, time, asyncio, random, html, base64, re, json, heapq, gzip
 import discord
 from discord import app_commands
 from aiohttp import web, ClientSession, ClientTimeout
 from typing import Optional, List, Dict, Any
+from collections import OrderedDict
 from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, unquote
 from datetime import datetime, timedelta, timezone
 
 # ---------- Transcript fallback / import ----------
 try:
-    from transcript_html import render_transcript_html
+    from transcript_html import render_transcript_html, TranscriptHtmlWriter, member_snapshot, guild_lookup
 except Exception:
+    TranscriptHtmlWriter = None
+    def member_snapshot(member):
+        return member.display_name, "", False
     async def render_transcript_html(guild, tinfo, messages, opener_name, use_msg_intent):
         rows = []
         rows.append("<html><head><meta charset='utf-8'><title>Transcript</title></head><body style='font-family:system-ui,Segoe UI,Arial,sans-serif;background:#0f172a;color:#e2e8f0'>")
@@ -47,10 +51,16 @@ def _sanitize_dsn(dsn: str) -> str:
     new_q = urlencode(qs)
     return urlunsplit((s.scheme, s.netloc, s.path, new_q, s.fragment))
 DATABASE_URL = _sanitize_dsn(os.getenv("DATABASE_URL", RAW_DSN).strip())
+# LISTEN/NOTIFY no pasa por el pooler de Neon: por defecto el mismo host sin "-pooler"
+DATABASE_LISTEN_URL = _sanitize_dsn(os.getenv("DATABASE_LISTEN_URL", "").strip() or DATABASE_URL.replace("-pooler.", ".", 1))
 
 API_SECRET = os.getenv("API_SECRET","").strip()
 MAX_CODES_INLINE = 25
+MAX_BATCH_REDEEM = int(os.getenv("MAX_BATCH_REDEEM", "100"))
 TICKET_INACTIVE_MIN = 180
+TICKET_MSG_PARTITIONED = env_truthy("TICKET_MSG_PARTITIONED", False)
+TICKET_MSG_RETENTION_DAYS = int(os.getenv("TICKET_MSG_RETENTION_DAYS", "0"))   # 0 = conservar siempre
+TICKET_MSG_RETENTION_DETACH = env_truthy("TICKET_MSG_RETENTION_DETACH", False)  # desacoplar en vez de borrar
 USE_MSG_INTENT = env_truthy("MESSAGE_CONTENT_INTENT", False)
 
 TRIVIA_USE_WEB = env_truthy("TRIVIA_USE_WEB", True)
@@ -91,11 +101,75 @@ def safe_ch_name(s: str) -> str:
     s = "".join(c for c in s if c.isalnum() or c in "-_")
     return s or "ticket"
 
+USER_CACHE_TTL = 600
+USER_CACHE_SIZE = 5000
+
+class UserCache:
+    """LRU+TTL de usuarios y miembros pedidos por REST; búsquedas simultáneas del mismo id comparten una sola llamada."""
+    def __init__(self, ttl: float = USER_CACHE_TTL, maxsize: int = USER_CACHE_SIZE):
+        self.ttl, self.maxsize = ttl, maxsize
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()   # clave -> (vence, objeto o None si no existe)
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.stats = {"gateway": 0, "hits": 0, "coalesced": 0, "rest_calls": 0, "not_found": 0, "evicted": 0}
+
+    async def _get(self, key: tuple, fetch):
+        hit = self._data.get(key)
+        if hit and hit[0] > time.monotonic():
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return hit[1]
+        fut = self._inflight.get(key)
+        if fut:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(fut)
+        fut = self._inflight[key] = asyncio.get_running_loop().create_future()
+        self.stats["rest_calls"] += 1
+        try:
+            obj = await fetch()
+        except discord.NotFound:
+            obj = None  # también se cachea: un id inexistente no se vuelve a pedir hasta que venza
+            self.stats["not_found"] += 1
+        except Exception as e:
+            fut.set_exception(e); fut.exception()  # marcar como leída aunque nadie más espere
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self._data[key] = (time.monotonic() + self.ttl, obj)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False); self.stats["evicted"] += 1
+        fut.set_result(obj)
+        return obj
+
+    async def user(self, uid: int) -> Optional[discord.User]:
+        uid = int(uid)
+        u = client.get_user(uid)
+        if u:
+            self.stats["gateway"] += 1
+            return u
+        return await self._get(("u", uid), lambda: client.fetch_user(uid))
+
+    async def member(self, guild: discord.Guild, uid: int) -> Optional[discord.Member]:
+        uid = int(uid)
+        m = guild.get_member(uid)
+        if m:
+            self.stats["gateway"] += 1
+            return m
+        return await self._get(("m", guild.id, uid), lambda: guild.fetch_member(uid))
+
+    def info(self) -> Dict[str, Any]:
+        lookups = self.stats["gateway"] + self.stats["hits"] + self.stats["coalesced"] + self.stats["rest_calls"]
+        saved = lookups - self.stats["rest_calls"]
+        return {"size": len(self._data), "inflight": len(self._inflight), **self.stats,
+                "rest_saved": saved, "hit_rate": round(saved / lookups, 4) if lookups else None}
+
+USERS = UserCache()
+
 async def fetch_member_name(guild: discord.Guild, uid: int) -> str:
     m = guild.get_member(uid)
     if m: return m.display_name
     try:
-        u = await client.fetch_user(uid); return u.name if u else str(uid)
+        u = await USERS.user(uid); return u.name if u else str(uid)
     except: return str(uid)
 
 def has_manage_guild(inter: discord.Interaction) -> bool:
@@ -179,7 +253,56 @@ async def get_bug_ids(g: discord.Guild):
     return int(in_ch), int(log_ch)
 
 # ===================== Categorías Tickets =====================
-async def get_or_create_ticket_category(guild: discord.Guild):
+class GuildMeta:
+    """Rol de staff y categorías de tickets por guild (solo ids); se invalida con eventos de roles/canales y cambios de config."""
+    def __init__(self):
+        self._data: Dict[int, dict] = {}   # guild_id -> {"staff": role_id|None, "open": category_id, "closed": category_id}
+        self._gen = 0
+        self.stats = {"hits": 0, "resolves": 0, "invalidations": 0}
+
+    def invalidate(self, guild_id: int, *keys: str):
+        self._gen += 1
+        self.stats["invalidations"] += 1
+        ent = self._data.get(guild_id)
+        if ent is None: return
+        if not keys: self._data.pop(guild_id, None); return
+        for k in keys: ent.pop(k, None)
+
+    def _put(self, guild_id: int, key: str, value, gen: int):
+        # si hubo una invalidación mientras resolvíamos, no guardar un resultado que puede estar viejo
+        if gen == self._gen:
+            self._data.setdefault(guild_id, {})[key] = value
+
+    async def staff_role(self, guild: discord.Guild) -> Optional[discord.Role]:
+        ent = self._data.get(guild.id, {})
+        if "staff" in ent:
+            role = guild.get_role(ent["staff"]) if ent["staff"] else None
+            if role or ent["staff"] is None:
+                self.stats["hits"] += 1
+                return role
+        gen = self._gen
+        self.stats["resolves"] += 1
+        role = await _resolve_staff_role(guild)
+        self._put(guild.id, "staff", role.id if role else None, gen)
+        return role
+
+    async def category(self, guild: discord.Guild, key: str, resolve) -> discord.CategoryChannel:
+        cat = guild.get_channel(self._data.get(guild.id, {}).get(key) or 0)
+        if isinstance(cat, discord.CategoryChannel):
+            self.stats["hits"] += 1
+            return cat
+        gen = self._gen
+        self.stats["resolves"] += 1
+        cat = await resolve(guild)
+        self._put(guild.id, key, cat.id, gen)
+        return cat
+
+    def info(self) -> Dict[str, Any]:
+        return {"guilds": len(self._data), **self.stats}
+
+GUILD_META = GuildMeta()
+
+async def _resolve_ticket_category(guild: discord.Guild) -> discord.CategoryChannel:
     cfg = await db.get_config(guild.id)
     cat = guild.get_channel(cfg.get("category_id") or 0)
     if isinstance(cat, discord.CategoryChannel): return cat
@@ -190,13 +313,13 @@ async def get_or_create_ticket_category(guild: discord.Guild):
     await db.set_category(guild.id, cat.id)
     return cat
 
-async def get_or_create_closed_category(guild: discord.Guild) -> discord.CategoryChannel:
+async def _resolve_closed_category(guild: discord.Guild) -> discord.CategoryChannel:
     for c in guild.categories:
         if "closed" in c.name.lower() or "cerrado" in c.name.lower() or "🗄️" in c.name:
             return c
     return await guild.create_category(name="🗄️ closed-tickets")
 
-async def resolve_staff_role(guild: discord.Guild) -> Optional[discord.Role]:
+async def _resolve_staff_role(guild: discord.Guild) -> Optional[discord.Role]:
     cfg = await db.get_config(guild.id)
     role = guild.get_role(cfg.get("staff_role_id") or 0)
     if role: return role
@@ -207,6 +330,41 @@ async def resolve_staff_role(guild: discord.Guild) -> Optional[discord.Role]:
         if r: return r
     return None
 
+async def get_or_create_ticket_category(guild: discord.Guild):
+    return await GUILD_META.category(guild, "open", _resolve_ticket_category)
+
+async def get_or_create_closed_category(guild: discord.Guild) -> discord.CategoryChannel:
+    return await GUILD_META.category(guild, "closed", _resolve_closed_category)
+
+async def resolve_staff_role(guild: discord.Guild) -> Optional[discord.Role]:
+    return await GUILD_META.staff_role(guild)
+
+@client.event
+async def on_guild_role_create(role: discord.Role):
+    GUILD_META.invalidate(role.guild.id, "staff")
+
+@client.event
+async def on_guild_role_delete(role: discord.Role):
+    GUILD_META.invalidate(role.guild.id, "staff")
+
+@client.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    GUILD_META.invalidate(after.guild.id, "staff")
+
+@client.event
+async def on_guild_channel_create(channel: discord.abc.GuildChannel):
+    if isinstance(channel, discord.CategoryChannel): GUILD_META.invalidate(channel.guild.id, "open", "closed")
+
+@client.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    if isinstance(channel, discord.CategoryChannel): GUILD_META.invalidate(channel.guild.id, "open", "closed")
+
+@client.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    # renombrar una categoría puede cambiar cuál coincide con "ticket"/"closed"
+    if isinstance(after, discord.CategoryChannel) and before.name != after.name:
+        GUILD_META.invalidate(after.guild.id, "open", "closed")
+
 # ===================== KEYS =====================
 @tree.command(name="checkkey", description="Verifica una key y entrega su premio (marca como usada).")
 @app_commands.describe(code="Código a canjear (ej: ABCD-EFGH-1234)")
@@ -235,17 +393,18 @@ async def checkkey_cmd(inter: discord.Interaction, code: str):
 
 @app_commands.default_permissions(manage_guild=True)
 @tree.command(name="genkey", description="Genera nuevas keys (admin).")
-@app_commands.describe(amount="Cantidad (1-100)", mode="random o fixed", prize="Premio (si fixed)", expires_days="Expira en N días (opcional)")
-async def genkey_cmd(inter: discord.Interaction, amount: app_commands.Range[int,1,100], mode: str, prize: str|None=None, expires_days: app_commands.Range[int,1,365]|None=None):
+@app_commands.describe(amount="Cantidad (1-100000)", mode="random o fixed", prize="Premio (si fixed)", expires_days="Expira en N días (opcional)")
+async def genkey_cmd(inter: discord.Interaction, amount: app_commands.Range[int,1,100000], mode: str, prize: str|None=None, expires_days: app_commands.Range[int,1,365]|None=None):
     if not has_manage_guild(inter):
         return await inter.response.send_message("Necesitas **Manage Server**.", ephemeral=True)
+    await inter.response.defer(ephemeral=True, thinking=True)
     res = await db.create_keys(amount, mode.lower().strip(), prize, inter.user.id, expires_days)
     if not res["ok"]:
         msg = {
             "prize_required":"Indica `prize` cuando `mode=fixed`.",
             "prize_not_found":"No encontré ese premio. Usa `/prize add` o `/prize list`."
         }.get(res.get("reason"), "Error creando claves.")
-        return await inter.response.send_message(msg, ephemeral=True)
+        return await inter.followup.send(msg, ephemeral=True)
 
     e = brand_embed("🧪 Claves generadas", color=COLORS["info"])
     e.add_field(name="Cantidad", value=str(len(res["codes"])), inline=True)
@@ -256,12 +415,12 @@ async def genkey_cmd(inter: discord.Interaction, amount: app_commands.Range[int,
         e.add_field(name="Expira en", value=f"{res['expires_days']} días", inline=True)
     if len(res["codes"]) <= MAX_CODES_INLINE:
         e.description = "```\n" + "\n".join("• " + c for c in res["codes"]) + "\n```"
-        await inter.response.send_message(embed=e, ephemeral=True)
+        await inter.followup.send(embed=e, ephemeral=True)
     else:
         content = "\n".join(res["codes"])
         file = discord.File(io.BytesIO(content.encode()), filename=f"keys_{int(time.time())}.txt")
         e.set_footer(text="Adjunté un archivo con las claves")
-        await inter.response.send_message(embed=e, file=file, ephemeral=True)
+        await inter.followup.send(embed=e, file=file, ephemeral=True)
 
 # ----------------------- PRIZE group -----------------------
 class PrizeGroup(app_commands.Group):
@@ -385,12 +544,12 @@ class PaymentMethodView(discord.ui.View):
     async def paypal(self, inter: discord.Interaction, button: discord.ui.Button):
         await db.set_payment_method(inter.channel.id, "paypal")
         await inter.response.send_message("✅ **PayPal** seleccionado. Espera a que el staff te atienda.", ephemeral=True)
-        await inter.channel.send("💸 **Pago por PayPal** seleccionado. Un staff te atenderá en breve.")
+        DISPATCH.send(inter.channel, content="💸 **Pago por PayPal** seleccionado. Un staff te atenderá en breve.")
     @discord.ui.button(label="Robux", style=discord.ButtonStyle.success, custom_id="pay_robux")
     async def robux(self, inter: discord.Interaction, button: discord.ui.Button):
         await db.set_payment_method(inter.channel.id, "robux")
         await inter.response.send_message("✅ **Robux** seleccionado. Envía el **link del Gamepass** cuando lo tengas.", ephemeral=True)
-        await inter.channel.send("🟩 **Pago con Robux** seleccionado. Comparte el **link del Gamepass**.")
+        DISPATCH.send(inter.channel, content="🟩 **Pago con Robux** seleccionado. Comparte el **link del Gamepass**.")
 
 class ControlsView(discord.ui.View):
     def __init__(self, timeout: Optional[float]=None): super().__init__(timeout=timeout)
@@ -400,14 +559,14 @@ class ControlsView(discord.ui.View):
             return await inter.response.send_message("Solo staff puede reclamar.", ephemeral=True)
         await db.set_claim(inter.channel.id, inter.user.id)
         await inter.response.send_message(f"✅ Ticket reclamado por {inter.user.mention}.", ephemeral=True)
-        await inter.channel.send(f"🎯 {inter.user.mention} ha **reclamado** este ticket.")
+        DISPATCH.send(inter.channel, content=f"🎯 {inter.user.mention} ha **reclamado** este ticket.")
     @discord.ui.button(label="🚫 Liberar", style=discord.ButtonStyle.secondary, custom_id="ticket_unclaim")
     async def unclaim(self, inter: discord.Interaction, button: discord.ui.Button):
         if not inter.user.guild_permissions.manage_messages:
             return await inter.response.send_message("Solo staff puede liberar.", ephemeral=True)
         await db.set_claim(inter.channel.id, None)
         await inter.response.send_message("✅ Ticket liberado.", ephemeral=True)
-        await inter.channel.send("🚫 El ticket fue **liberado**.")
+        DISPATCH.send(inter.channel, content="🚫 El ticket fue **liberado**.")
     @discord.ui.button(label="✅ Cerrar", style=discord.ButtonStyle.success, custom_id="ticket_close")
     async def close(self, inter: discord.Interaction, button: discord.ui.Button):
         modal = CloseModal(); await inter.response.send_modal(modal)
@@ -440,22 +599,23 @@ class TicketPanel(discord.ui.View):
             r = inter.guild.get_role(rid)
             if r: overwrites[r] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
         channel = await inter.guild.create_text_channel(name=ch_name, category=cat, overwrites=overwrites, reason=f"Ticket {kind} de {user}")
-        await db.create_ticket(inter.guild.id, user.id, kind, channel.id)
+        tid = await db.create_ticket(inter.guild.id, user.id, kind, channel.id)
+        TICKETS.track(tid, channel.id, user.id)
         staff_ping = staff_role.mention if staff_role else (inter.guild.owner.mention if inter.guild.owner else "")
         header = "🛒 **Ticket de Compra**" if kind=="comprar" else "🛠️ **Ticket de Soporte**"
         desc   = "Selecciona lo que deseas comprar en el menú de abajo." if kind=="comprar" else "Cuéntanos tu problema y el staff te ayudará."
         e = brand_embed("🎟️ Ticket creado", f"{header}\n**Usuario:** {user.mention}\n\n{desc}", COLORS["ticket"])
-        await channel.send(content=staff_ping, embed=e, view=ControlsView())
+        DISPATCH.send(channel, content=staff_ping, embed=e, view=ControlsView())
         if kind == "comprar":
             lines = "\n".join([f"• {label}" for (label, _) in BUY_PLANS])
-            await channel.send(embed=brand_embed("📆 Optional Support Prices", lines, COLORS["accent"]))
+            DISPATCH.send(channel, embed=brand_embed("📆 Optional Support Prices", lines, COLORS["accent"]))
             view = discord.ui.View(timeout=600); view.add_item(BuyPlanSelect())
-            try:
-                await user.send(embed=brand_embed("🛒 Elige tu plan", "Selecciona una opción y luego el método de pago.", COLORS["info"]))
-                await user.send(view=view)
-                await channel.send(f"{user.mention} te envié un DM para elegir el plan. Si no llega, usa este menú aquí:", view=view)
-            except Exception:
-                await channel.send(content=f"{user.mention}", embed=brand_embed("🛒 Elige tu plan", "Selecciona una opción y luego el método de pago.", COLORS["info"]), view=view)
+            async def after_dm(ok: bool):
+                if ok:
+                    DISPATCH.send(channel, content=f"{user.mention} te envié un DM para elegir el plan. Si no llega, usa este menú aquí:", view=view)
+                else:
+                    DISPATCH.send(channel, content=f"{user.mention}", embed=brand_embed("🛒 Elige tu plan", "Selecciona una opción y luego el método de pago.", COLORS["info"]), view=view)
+            await DMS.send(user.id, on_done=after_dm, embed=brand_embed("🛒 Elige tu plan", "Selecciona una opción y luego el método de pago.", COLORS["info"]), view=view)
         await inter.response.send_message(f"✅ Ticket creado: {channel.mention}", ephemeral=True)
 
 class TicketGroup(app_commands.Group):
@@ -488,6 +648,17 @@ class TicketGroup(app_commands.Group):
         if motivo is None: return await inter.response.send_modal(CloseModal())
         await perform_close(inter, motivo)
 
+    @app_commands.command(name="transcript", description="Descarga la transcripción archivada de un ticket (staff).")
+    @app_commands.default_permissions(manage_messages=True)
+    @app_commands.rename(ticket_id="id")
+    @app_commands.describe(ticket_id="Número del ticket")
+    async def transcript(self, inter: discord.Interaction, ticket_id: int):
+        if not inter.guild: return await inter.response.send_message("Solo en servidores.", ephemeral=True)
+        await inter.response.defer(ephemeral=True, thinking=True)
+        tr = await load_transcript(inter.guild, ticket_id)
+        if not tr: return await inter.followup.send("No hay transcripción para ese ticket (¿sigue abierto o es de otro servidor?).", ephemeral=True)
+        await inter.followup.send(f"📄 Transcripción del ticket #{ticket_id}", files=tr.files(), ephemeral=True)
+
     @app_commands.command(name="reopen", description="Reabre un ticket cerrado (staff).")
     @app_commands.default_permissions(manage_messages=True)
     async def reopen(self, inter: discord.Interaction):
@@ -499,11 +670,12 @@ class TicketGroup(app_commands.Group):
         cat = await get_or_create_ticket_category(inter.guild)
         await inter.channel.edit(category=cat, name=f"ticket-reopened-{inter.channel.name}"[:95])
         opener_id = int(t["opener_id"])
-        opener_member = inter.guild.get_member(opener_id) or await inter.guild.fetch_member(opener_id)
+        opener_member = await USERS.member(inter.guild, opener_id)
         if opener_member:
             allow = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
             await inter.channel.set_permissions(opener_member, overwrite=allow, reason="Ticket reabierto: restaurar acceso del autor")
-        await db.reopen_ticket_by_channel(inter.channel.id)
+        row = await db.reopen_ticket_by_channel(inter.channel.id)
+        if row: TICKETS.track_row(row)
         await inter.response.send_message("✅ Ticket reabierto.", ephemeral=True)
 
     @app_commands.command(name="adduser", description="Añade un usuario al ticket (staff).")
@@ -562,7 +734,7 @@ tree.add_command(TicketAllowRoleGroup(), guild=None, override=True)
 
 async def apply_closed_effects(channel: discord.TextChannel, opener_id: int):
     try:
-        opener_member = channel.guild.get_member(opener_id) or await channel.guild.fetch_member(opener_id)
+        opener_member = await USERS.member(channel.guild, opener_id)
         if opener_member and not opener_member.guild_permissions.administrator:
             await channel.set_permissions(opener_member, overwrite=None)
             deny = discord.PermissionOverwrite(view_channel=False, send_messages=False, read_message_history=False)
@@ -581,6 +753,135 @@ async def apply_closed_effects(channel: discord.TextChannel, opener_id: int):
         await channel.edit(name=new_name[:95])
     except Exception: pass
 
+class Transcript:
+    """Bytes de las transcripciones de un ticket: se generan una vez y se reutilizan en el canal y el DM."""
+    __slots__ = ("ticket_id", "txt", "html")
+    def __init__(self, ticket_id: int, txt: bytes, html: bytes):
+        self.ticket_id, self.txt, self.html = ticket_id, txt, html
+
+    def files(self, suffix: str = "") -> List[discord.File]:
+        # discord.File consume su stream al enviarse: cada envío necesita el suyo, pero comparten los bytes
+        return [discord.File(io.BytesIO(self.txt), filename=f"ticket_{self.ticket_id}{suffix}.txt"),
+                discord.File(io.BytesIO(self.html), filename=f"ticket_{self.ticket_id}{suffix}.html")]
+
+def write_transcript_txt(out: io.BytesIO, page) -> None:
+    lines = []
+    for m in page:
+        stamp = m["created_at"].strftime("%Y-%m-%d %H:%M:%S")
+        content = m["content"] or ""
+        atts = m["attachments"] or []
+        if atts: content += " " + " ".join(atts)
+        lines.append(f"[{stamp}] ({m['author_id']}): {content}")
+    if lines:
+        out.write((("\n" if out.tell() else "") + "\n".join(lines)).encode("utf-8"))
+
+def _write_transcript_page(txt: io.BytesIO, writer, page) -> None:
+    write_transcript_txt(txt, page)
+    writer.write_messages(page)
+
+async def build_transcript(guild: discord.Guild, tinfo: Dict, pages) -> Transcript:
+    """Consume las páginas de mensajes (async iterable) escribiendo ambas transcripciones a la vez; la memoria no crece con el ticket."""
+    txt, html_out = io.BytesIO(), io.BytesIO()
+    snapshots = await db.ticket_authors(int(tinfo["id"]))
+    opener = snapshots.get(int(tinfo["opener_id"]))
+    opener_name = opener[0] if opener else await fetch_member_name(guild, tinfo["opener_id"])
+    if TranscriptHtmlWriter is None:  # renderizador de respaldo: necesita todos los mensajes juntos
+        rows = []
+        async for page in pages:
+            write_transcript_txt(txt, page); rows.extend(page)
+        html_out.write(await render_transcript_html(guild, tinfo, rows, opener_name, USE_MSG_INTENT))
+    else:
+        # autores sin snapshot (tickets anteriores a ticket_authors) se resuelven con la caché del guild
+        w = TranscriptHtmlWriter(html_out, guild, tinfo, opener_name, USE_MSG_INTENT, snapshots, guild_lookup(guild))
+        w.begin()
+        async for page in pages:
+            w.resolve_authors(page)  # en el loop; el resto de la página se escribe en un hilo
+            await asyncio.to_thread(_write_transcript_page, txt, w, page)
+        w.end()
+    if not txt.tell(): txt.write("No hubo mensajes.".encode("utf-8"))
+    return Transcript(int(tinfo["id"]), txt.getvalue(), html_out.getvalue())
+
+async def load_transcript(guild: discord.Guild, ticket_id: int) -> Optional[Transcript]:
+    """Transcripción archivada del ticket; si es un ticket cerrado anterior al archivo, se genera y archiva una vez."""
+    arch = await db.fetch_transcript(ticket_id)
+    if arch:
+        if int(arch["guild_id"]) != guild.id: return None
+        txt, html_bytes = await asyncio.to_thread(lambda: (gzip.decompress(arch["txt"]["gz"]), gzip.decompress(arch["html"]["gz"])))
+        return Transcript(ticket_id, txt, html_bytes)
+    t = await db.fetch_ticket(ticket_id)
+    if not t or int(t["guild_id"]) != guild.id or t["status"] != "closed": return None
+    tr = await build_transcript(guild, t, db.iter_ticket_messages(ticket_id))
+    await db.archive_transcript(ticket_id, guild.id, tr.txt, tr.html)
+    return tr
+
+TICKET_CLOSE_WORKERS = int(os.getenv("TICKET_CLOSE_WORKERS", "3"))
+TICKET_CLOSE_QUEUE = 200
+
+class TicketClosePipeline:
+    """Cierres de ticket (manuales y por inactividad) en una cola con un número fijo de workers."""
+    def __init__(self, workers: int = TICKET_CLOSE_WORKERS, maxsize: int = TICKET_CLOSE_QUEUE):
+        self.workers = max(1, workers)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.stats = {"queued": 0, "closed": 0, "failed": 0, "max_depth": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+
+    async def submit(self, channel: discord.TextChannel, closed_by: int, reason: str, auto: bool = False) -> asyncio.Future:
+        """Encola el cierre; el future se resuelve a True/False cuando termina. Espera si la cola está llena."""
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((channel, closed_by, reason, auto, fut, time.perf_counter()))
+        self.stats["queued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+        return fut
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+    async def _worker(self):
+        while not client.is_closed():
+            try: channel, closed_by, reason, auto, fut, t0 = await asyncio.wait_for(self.queue.get(), timeout=5)
+            except asyncio.TimeoutError: continue
+            try:
+                ok = await self._close(channel, closed_by, reason, auto)
+                if not fut.done(): fut.set_result(ok)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print("[tickets] cierre fallido:", e)
+                if not fut.done(): fut.set_result(False)
+            finally:
+                ms = (time.perf_counter() - t0) * 1000  # incluye la espera en cola
+                self.stats["last_ms"] = ms; self.stats["max_ms"] = max(self.stats["max_ms"], ms); self.stats["total_ms"] += ms
+                self.queue.task_done()
+
+    async def _close(self, channel: discord.TextChannel, closed_by: int, reason: str, auto: bool) -> bool:
+        tinfo = await db.close_ticket_by_channel(channel.id, closed_by, reason)
+        if not tinfo: return False
+        TICKETS.untrack(tinfo["id"])
+        # ya está cerrado en la DB: desde aquí cada efecto falla por su cuenta y el cierre cuenta como hecho
+        tr = None
+        try:
+            tr = await build_transcript(channel.guild, tinfo, db.iter_ticket_messages(tinfo["id"]))
+            await db.archive_transcript(tr.ticket_id, channel.guild.id, tr.txt, tr.html)
+        except Exception as ex: print(f"[tickets] no pude generar/archivar la transcripción de #{tinfo['id']}:", ex)
+        if auto:
+            e = brand_embed("🛑 Ticket cerrado por inactividad (3h)", color=COLORS["error"])
+            dm = brand_embed("Tu ticket fue cerrado por inactividad", color=COLORS["info"])
+        else:
+            e = brand_embed("✅ Ticket cerrado", f"Motivo: {reason or '—'}", COLORS["success"])
+            dm = brand_embed("Tu ticket fue cerrado", f"Motivo: {reason or '—'}", COLORS["info"])
+        try: await channel.send(embed=e, files=tr.files("_transcript") if tr else [], view=None)
+        except Exception as ex: print(f"[tickets] no pude publicar el cierre de #{tinfo['id']}:", ex)
+        try: await apply_closed_effects(channel, int(tinfo["opener_id"]))
+        except Exception as ex: print(f"[tickets] no pude aplicar los efectos de cierre de #{tinfo['id']}:", ex)
+        try: await DMS.send(tinfo["opener_id"], embed=dm, files=tr.files() if tr else [])
+        except Exception as ex: print(f"[tickets] no pude encolar el DM de cierre de #{tinfo['id']}:", ex)
+        self.stats["closed"] += 1
+        return True
+
+    def info(self) -> Dict[str, Any]:
+        done = self.stats["closed"] + self.stats["failed"]
+        return {"workers": self.workers, "depth": self.queue.qsize(), **self.stats, "avg_ms": self.stats["total_ms"] / max(1, done)}
+
+TICKET_CLOSER = TicketClosePipeline()
+
 async def perform_close(inter: discord.Interaction, motivo: str):
     if not inter.guild or not isinstance(inter.channel, discord.TextChannel):
         return await inter.response.send_message("Usa esto dentro del canal del ticket.", ephemeral=True)
@@ -592,34 +893,8 @@ async def perform_close(inter: discord.Interaction, motivo: str):
         return await inter.response.send_message("No tienes permisos para cerrar este ticket.", ephemeral=True)
 
     await inter.response.defer(ephemeral=True, thinking=True)
-    data = await db.close_ticket_by_channel(inter.channel.id, inter.user.id, motivo or "")
-    if not data: return await inter.followup.send("No pude cerrar el ticket.", ephemeral=True)
-    tinfo, messages = data
-
-    lines = []
-    for m in messages:
-        stamp = m["created_at"].strftime("%Y-%m-%d %H:%M:%S")
-        content = m["content"] or ""
-        atts = m["attachments"] or []
-        if atts: content += " " + " ".join(atts)
-        lines.append(f"[{stamp}] ({m['author_id']}): {content}")
-    txt = "\n".join(lines) if lines else "No hubo mensajes."
-    file_txt = discord.File(io.BytesIO(txt.encode("utf-8")), filename=f"ticket_{tinfo['id']}_transcript.txt")
-
-    opener_name = await fetch_member_name(inter.guild, tinfo["opener_id"])
-    html_bytes = await render_transcript_html(inter.guild, tinfo, messages, opener_name, USE_MSG_INTENT)
-    file_html = discord.File(io.BytesIO(html_bytes), filename=f"ticket_{tinfo['id']}_transcript.html")
-
-    e = brand_embed("✅ Ticket cerrado", f"Motivo: {motivo or '—'}", COLORS["success"])
-    await inter.channel.send(embed=e, files=[file_txt, file_html], view=None)
-    await apply_closed_effects(inter.channel, int(tinfo["opener_id"]))
-    try:
-        user = await client.fetch_user(tinfo["opener_id"])
-        if user:
-            await user.send(embed=brand_embed("Tu ticket fue cerrado", f"Motivo: {motivo or '—'}", COLORS["info"]))
-            await user.send(files=[discord.File(io.BytesIO(txt.encode()), filename=f"ticket_{tinfo['id']}.txt"),
-                                   discord.File(io.BytesIO(html_bytes), filename=f"ticket_{tinfo['id']}.html")])
-    except Exception: pass
+    fut = await TICKET_CLOSER.submit(inter.channel, inter.user.id, motivo or "")
+    if not await fut: return await inter.followup.send("No pude cerrar el ticket.", ephemeral=True)
     await inter.followup.send("Ticket cerrado, autor sin acceso y transcripciones enviadas.", ephemeral=True)
 
 # =================== BUGS ===================
@@ -723,6 +998,17 @@ async def require_api_key(request):
 
 async def api_ping(request): return web.json_response({"ok": True, "ts": int(time.time()*1000)})
 
+async def api_stats(request):
+    if not await require_api_key(request):
+        return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+    stages = {n: {**st, "avg_ms": st["total_ms"] / max(1, st["calls"])} for n, st in STAGE_STATS.items()}
+    return web.json_response({"ok": True, "db": db.stats(), "xp": {"cached": len(XP.users), "dirty": len(XP.dirty), **XP.stats},
+                              "on_message": stages, "ticket_scheduler": TICKETS.info(),
+                              "ticket_close": TICKET_CLOSER.info(),
+                              "user_cache": USERS.info(),
+                              "guild_meta": GUILD_META.info(), "send_queue": DISPATCH.info(),
+                              "dm": DMS.info(), "giveaways": {**GIVEAWAYS.info(), "counter": GIVEAWAY_COUNTER.stats}})
+
 async def api_checkkey(request):
     if not await require_api_key(request):
         return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
@@ -734,6 +1020,47 @@ async def api_checkkey(request):
     except Exception as e:
         return web.json_response({"ok": False, "error": str(e)}, status=400)
 
+async def api_checkkey_batch(request):
+    if not await require_api_key(request):
+        return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+    try:
+        body = await request.json()
+        codes = body.get("codes") or []; player_id = body.get("playerId")
+        if not isinstance(codes, list) or not codes or len(codes) > MAX_BATCH_REDEEM:
+            return web.json_response({"ok": False, "error": f"codes debe ser una lista de 1-{MAX_BATCH_REDEEM} códigos"}, status=400)
+        codes = [str(c) for c in codes]
+        results = await db.check_keys(codes, player_id)
+        out = [{"code": code, **(res if res["ok"] else {"ok": False, "reason": res.get("reason")})} for code, res in zip(codes, results)]
+        return web.json_response({"ok": True, "results": out})
+    except Exception as e:
+        return web.json_response({"ok": False, "error": str(e)}, status=400)
+
+async def api_genkey_stream(request, count: int, mode: str, prize, expires):
+    # NDJSON: una línea {"code": ...} por key en cuanto su tanda queda confirmada, y una línea final de resumen
+    mode, reason = await db.validate_key_request(count, mode, prize)
+    if reason:
+        return web.json_response({"ok": False, "reason": reason}, status=400)
+    resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await resp.prepare(request)
+    n, error = 0, None
+    batches = db.create_keys_iter(count, mode, prize, expires)
+    try:
+        while True:
+            try: codes = await batches.__anext__()
+            except StopAsyncIteration: break
+            except Exception as e:  # solo los fallos al generar van en el resumen
+                error = e; break
+            await resp.write("".join(json.dumps({"code": c}) + "\n" for c in codes).encode())
+            n += len(codes)
+        summary = {"ok": True, "count": n} if error is None else {"ok": False, "count": n, "error": str(error)}
+        await resp.write((json.dumps(summary) + "\n").encode())
+        await resp.write_eof()
+    except ConnectionResetError:
+        pass  # el cliente se fue: lo ya confirmado queda creado, no se generan más tandas ni hay a quién escribir
+    finally:
+        await batches.aclose()
+    return resp
+
 async def api_genkey(request):
     if not await require_api_key(request):
         return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
@@ -741,6 +1068,8 @@ async def api_genkey(request):
         body = await request.json()
         count = int(body.get("count",1)); mode = str(body.get("mode","random")).lower()
         prize = body.get("prizeName"); expires = body.get("expiresDays")
+        if body.get("stream") or request.query.get("stream","").lower() in {"1","true","yes","on"}:
+            return await api_genkey_stream(request, count, mode, prize, expires)
         res = await db.create_keys(count, mode, prize, created_by=None, expires_days=expires)
         if not res["ok"]:
             return web.json_response({"ok": False, "reason": res.get("reason")}, status=400)
@@ -748,12 +1077,39 @@ async def api_genkey(request):
     except Exception as e:
         return web.json_response({"ok": False, "error": str(e)}, status=400)
 
+async def api_transcript(request):
+    # sirve los bytes archivados sin regenerar; si el cliente acepta gzip van tal cual están guardados
+    if not await require_api_key(request):
+        return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+    try: ticket_id = int(request.match_info["ticket_id"])
+    except ValueError: return web.json_response({"ok": False, "error": "bad_id"}, status=400)
+    fmt = request.query.get("format", "html").lower()
+    if fmt not in ("html", "txt"):
+        return web.json_response({"ok": False, "error": "bad_format"}, status=400)
+    arch = await db.fetch_transcript(ticket_id)
+    if not arch:
+        return web.json_response({"ok": False, "error": "not_found"}, status=404)
+    blob = arch[fmt]
+    etag = f'"{blob["sha256"]}"'
+    headers = {"ETag": etag, "Content-Disposition": f'inline; filename="ticket_{ticket_id}.{fmt}"'}
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers=headers)
+    ctype = "text/html" if fmt == "html" else "text/plain"
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return web.Response(body=blob["gz"], content_type=ctype, charset="utf-8", headers=headers)
+    body = await asyncio.to_thread(gzip.decompress, blob["gz"])
+    return web.Response(body=body, content_type=ctype, charset="utf-8", headers=headers)
+
 async def run_web():
     app = web.Application()
     app.add_routes([
         web.get("/api/ping", api_ping),
+        web.get("/api/stats", api_stats),
         web.post("/api/checkkey", api_checkkey),
+        web.post("/api/checkkey/batch", api_checkkey_batch),
         web.post("/api/genkey", api_genkey),
+        web.get("/api/transcript/{ticket_id}", api_transcript),
     ])
     runner = web.AppRunner(app); await runner.setup()
     port = int(os.getenv("PORT","8080")); site = web.TCPSite(runner, "0.0.0.0", port)
@@ -829,31 +1185,85 @@ async def econ_add(inter: discord.Interaction, uid: int, amount: int):
 def level_xp_needed(level: int) -> int:
     return 100 + (level-1)*50
 
-async def levels_gain_xp(guild_id: int, user_id: int, base_xp: int=10):
-    async with db.pool.acquire() as c:
-        row = await c.fetchrow("SELECT xp, level, last_xp_at FROM levels_users WHERE guild_id=$1 AND user_id=$2", guild_id, user_id)
+XP_COOLDOWN_S = 60
+XP_FLUSH_INTERVAL = 5
+XP_IDLE_EVICT_S = 900
+
+class XpEngine:
+    """XP en memoria: cooldown y subidas de nivel se calculan aquí y se persisten en lote a levels_users."""
+    def __init__(self):
+        self.users: Dict[tuple, list] = {}   # (guild_id, user_id) -> [xp, level, last_xp_at]
+        self.dirty: set = set()
+        self.stats = {"gains": 0, "cooldown": 0, "loads": 0, "flushes": 0, "rows": 0, "last_ms": 0.0, "max_ms": 0.0}
+
+    async def _load(self, key: tuple) -> list:
+        async with db.pool.acquire() as c:
+            row = await c.fetchrow("SELECT xp, level, last_xp_at FROM levels_users WHERE guild_id=$1 AND user_id=$2", *key)
+        self.stats["loads"] += 1
+        st = self.users.get(key)  # otro mensaje del mismo usuario pudo cargarlo mientras esperábamos
+        if st is None:
+            st = [int(row["xp"]), int(row["level"]), row["last_xp_at"]] if row else [0, 1, None]
+            self.users[key] = st
+        return st
+
+    def peek(self, guild_id: int, user_id: int) -> Optional[list]:
+        return self.users.get((guild_id, user_id))
+
+    async def gain(self, guild_id: int, user_id: int, base_xp: int=10) -> Optional[int]:
+        key = (guild_id, user_id)
+        st = self.users.get(key) or await self._load(key)
         now = datetime.now(timezone.utc)
-        if not row:
-            xp = base_xp; lvl = 1
-            await c.execute("INSERT INTO levels_users(guild_id,user_id,xp,level,last_xp_at) VALUES($1,$2,$3,$4,$5)",
-                            guild_id, user_id, xp, lvl, now)
+        last = st[2]
+        self.dirty.add(key)
+        if last and (now - last).total_seconds() < XP_COOLDOWN_S:
+            st[2] = now  # igual que antes: hablar durante el cooldown lo renueva
+            self.stats["cooldown"] += 1
             return None
-        last = row["last_xp_at"]
-        if last and (now - last).total_seconds() < 60:
-            await c.execute("UPDATE levels_users SET last_xp_at=$1 WHERE guild_id=$2 AND user_id=$3", now, guild_id, user_id)
-            return None
-        xp = int(row["xp"]) + base_xp
-        lvl = int(row["level"])
+        xp = st[0] + base_xp
+        lvl = st[1]
         leveled = None
         while xp >= level_xp_needed(lvl):
             xp -= level_xp_needed(lvl)
             lvl += 1
             leveled = lvl
-        await c.execute("UPDATE levels_users SET xp=$1, level=$2, last_xp_at=$3 WHERE guild_id=$4 AND user_id=$5",
-                        xp, lvl, now, guild_id, user_id)
+        st[0], st[1], st[2] = xp, lvl, now
+        self.stats["gains"] += 1
         return leveled
 
+    async def flush(self) -> int:
+        if not self.dirty: return 0
+        keys, self.dirty = self.dirty, set()
+        rows = [(k[0], k[1], *self.users[k]) for k in keys if k in self.users]
+        t0 = time.perf_counter()
+        try:
+            async with db.pool.acquire() as c:
+                await c.execute("""
+                INSERT INTO levels_users(guild_id,user_id,xp,level,last_xp_at)
+                SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::int[], $5::timestamptz[])
+                ON CONFLICT (guild_id,user_id) DO UPDATE
+                  SET xp=EXCLUDED.xp, level=EXCLUDED.level, last_xp_at=EXCLUDED.last_xp_at
+                """, *[list(col) for col in zip(*rows)])
+        except Exception:
+            self.dirty |= keys
+            raise
+        ms = (time.perf_counter() - t0) * 1000
+        self.stats["flushes"] += 1; self.stats["rows"] += len(rows)
+        self.stats["last_ms"] = ms; self.stats["max_ms"] = max(self.stats["max_ms"], ms)
+        # soltar usuarios inactivos ya persistidos para que la memoria no crezca sin límite
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=XP_IDLE_EVICT_S)
+        for k in [k for k, st in self.users.items() if k not in self.dirty and (st[2] is None or st[2] < cutoff)]:
+            del self.users[k]
+        return len(rows)
+
+XP = XpEngine()
+
+async def levels_gain_xp(guild_id: int, user_id: int, base_xp: int=10):
+    return await XP.gain(guild_id, user_id, base_xp)
+
 async def levels_get(inter: discord.Interaction, uid: int) -> Dict[str,Any]:
+    st = XP.peek(inter.guild.id, uid)
+    if st:  # XP aún sin volcar
+        return {"guild_id": inter.guild.id, "user_id": uid, "xp": st[0], "level": st[1], "last_xp_at": st[2]}
     async with db.pool.acquire() as c:
         row = await c.fetchrow("SELECT * FROM levels_users WHERE guild_id=$1 AND user_id=$2", inter.guild.id, uid)
         if not row:
@@ -958,6 +1368,8 @@ async def level_cmd(inter: discord.Interaction, usuario: Optional[discord.User]=
 @tree.command(name="rank", description="Top de niveles en el servidor.")
 async def rank_cmd(inter: discord.Interaction, top: app_commands.Range[int,1,20]=10):
     if not inter.guild: return await inter.response.send_message("Solo en servidores.", ephemeral=True)
+    try: await XP.flush()  # el ranking debe incluir la XP pendiente
+    except Exception: pass
     async with db.pool.acquire() as c:
         rows = await c.fetch("""
         SELECT user_id, level, xp FROM levels_users
@@ -980,9 +1392,7 @@ async def warn_cmd(inter: discord.Interaction, usuario: discord.User, razon: Opt
     await warn_add(inter, usuario.id, razon or "—")
     e = brand_embed("⚠️ Advertencia", f"{usuario.mention} fue advertido.\n**Motivo:** {razon or '—'}", COLORS["warn"])
     await inter.response.send_message(embed=e, ephemeral=True)
-    try:
-        await usuario.send(embed=brand_embed("⚠️ Has sido advertido", f"Servidor: **{inter.guild.name}**\nMotivo: {razon or '—'}", COLORS["warn"]))
-    except Exception: pass
+    await DMS.send(usuario.id, embed=brand_embed("⚠️ Has sido advertido", f"Servidor: **{inter.guild.name}**\nMotivo: {razon or '—'}", COLORS["warn"]))
 
 @tree.command(name="infractions", description="Muestra advertencias de un usuario.")
 async def infractions_cmd(inter: discord.Interaction, usuario: Optional[discord.User]=None):
@@ -1026,134 +1436,424 @@ async def poll_cmd(inter: discord.Interaction, pregunta: str, opcion1: str, opci
         pass
     await inter.response.send_message("✅ Encuesta publicada.", ephemeral=True)
 
+# =================== Envíos salientes ===================
+PRIO_MOD, PRIO_NORMAL, PRIO_LEVELUP = 0, 1, 2   # menor = antes
+SEND_QUEUE_MAX = 200          # por canal; por encima solo se descartan anuncios de nivel
+LEVELUP_COALESCE_MAX = 40     # menciones por embed agrupado
+
+class SendDispatcher:
+    """Envíos en colas por canal con prioridad (un 429 solo frena a su canal); los anuncios de nivel en cola se agrupan."""
+    def __init__(self):
+        self.queues: Dict[int, list] = {}           # channel_id -> heap de (prioridad, seq, trabajo)
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.levelups: Dict[int, dict] = {}         # channel_id -> {user_id: nivel} del anuncio aún en cola
+        self._seq = 0
+        self.stats = {"enqueued": 0, "sent": 0, "failed": 0, "coalesced": 0, "dropped": 0, "max_depth": 0,
+                      "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+
+    def _push(self, channel_id: int, prio: int, fn, kwargs: dict, on_sent=None) -> bool:
+        q = self.queues.setdefault(channel_id, [])
+        if len(q) >= SEND_QUEUE_MAX and prio >= PRIO_LEVELUP:
+            self.stats["dropped"] += 1
+            return False
+        heapq.heappush(q, (prio, self._seq, (fn, kwargs, on_sent, time.perf_counter())))
+        self._seq += 1
+        self.stats["enqueued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.depth())
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self._worker(channel_id))
+        return True
+
+    def send(self, channel: discord.abc.Messageable, prio: int = PRIO_NORMAL, on_sent=None, **kwargs) -> bool:
+        """Encola channel.send(**kwargs); `on_sent(msg)` (corrutina) corre tras enviarse."""
+        return self._push(channel.id, prio, channel.send, kwargs, on_sent)
+
+    def reply(self, message: discord.Message, prio: int = PRIO_NORMAL, on_sent=None, **kwargs) -> bool:
+        return self._push(message.channel.id, prio, message.reply, kwargs, on_sent)
+
+    def levelup(self, channel: discord.TextChannel, user_id: int, level: int):
+        pending = self.levelups.get(channel.id)
+        if pending is not None and len(pending) < LEVELUP_COALESCE_MAX:
+            pending[user_id] = max(pending.get(user_id, 0), level)
+            self.stats["coalesced"] += 1
+            return
+        pending = {user_id: level}
+        # registrar solo si entró en la cola: si no, los siguientes se agruparían en un anuncio que nunca sale
+        if self._push(channel.id, PRIO_LEVELUP, self._send_levelups, {"channel": channel, "entries": pending}):
+            self.levelups[channel.id] = pending
+
+    async def _send_levelups(self, channel: discord.TextChannel, entries: dict):
+        if self.levelups.get(channel.id) is entries:  # a partir de aquí los nuevos van a otro anuncio
+            del self.levelups[channel.id]
+        if len(entries) == 1:
+            (uid, lvl), = entries.items()
+            return await channel.send(embed=brand_embed("🆙 ¡Subiste de nivel!", f"<@{uid}> ahora es **Nivel {lvl}** 🎉", COLORS["success"]))
+        lines = "\n".join(f"<@{uid}> ahora es **Nivel {lvl}**" for uid, lvl in entries.items())
+        return await channel.send(embed=brand_embed("🆙 ¡Subidas de nivel!", f"{lines}\n🎉", COLORS["success"]))
+
+    async def _worker(self, channel_id: int):
+        q = self.queues[channel_id]
+        try:
+            while q:
+                _, _, (fn, kwargs, on_sent, t0) = heapq.heappop(q)
+                try:
+                    msg = await fn(**kwargs)
+                    if on_sent: await on_sent(msg)
+                    self.stats["sent"] += 1
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    print(f"[send] canal {channel_id}:", e)
+                ms = (time.perf_counter() - t0) * 1000  # desde que se encoló
+                st = self.stats
+                st["last_ms"] = ms; st["max_ms"] = max(st["max_ms"], ms); st["total_ms"] += ms
+        finally:
+            self.workers.pop(channel_id, None)
+            if not q: self.queues.pop(channel_id, None)
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def info(self) -> Dict[str, Any]:
+        done = self.stats["sent"] + self.stats["failed"]
+        return {"depth": self.depth(), "channels": len(self.queues), **self.stats, "avg_ms": self.stats["total_ms"] / max(1, done)}
+
+DISPATCH = SendDispatcher()
+
+DM_WORKERS = int(os.getenv("DM_WORKERS", "4"))
+DM_QUEUE_MAX = 1000
+DM_BLOCK_TTL = 3600   # segundos sin reintentar a quien tiene los DMs cerrados
+
+class DmService:
+    """Entrega de DMs con un número fijo de workers; los destinatarios que rechazan DMs se saltan durante un rato."""
+    def __init__(self, workers: int = DM_WORKERS, maxsize: int = DM_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.blocked: Dict[int, float] = {}   # user_id -> hasta cuándo no intentar (monotonic)
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "skipped": 0, "dropped": 0, "max_depth": 0,
+                      "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+
+    def is_blocked(self, uid: int) -> bool:
+        until = self.blocked.get(uid)
+        if until is None: return False
+        if until > time.monotonic(): return True
+        del self.blocked[uid]
+        return False
+
+    async def send(self, uid: int, on_done=None, **kwargs) -> asyncio.Future:
+        """Encola user.send(**kwargs); el future (y `on_done(ok)`, corrutina) reciben True si se entregó."""
+        uid = int(uid)
+        fut = asyncio.get_running_loop().create_future()
+        if self.is_blocked(uid):
+            self.stats["skipped"] += 1
+            fut.set_result(False)
+            if on_done: await on_done(False)
+            return fut
+        try: self.queue.put_nowait((uid, kwargs, on_done, fut, time.perf_counter()))
+        except asyncio.QueueFull:  # no frenar al llamador (interacciones, cierres) por una cola de DMs llena
+            self.stats["dropped"] += 1
+            fut.set_result(False)
+            if on_done: await on_done(False)
+            return fut
+        self.stats["queued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+        return fut
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+    async def _worker(self):
+        while not client.is_closed():
+            try: uid, kwargs, on_done, fut, t0 = await asyncio.wait_for(self.queue.get(), timeout=5)
+            except asyncio.TimeoutError: continue
+            ok = False
+            try:
+                if self.is_blocked(uid):  # se bloqueó mientras esperaba en cola
+                    self.stats["skipped"] += 1
+                else:
+                    user = await USERS.user(uid)
+                    if user is None:
+                        self.blocked[uid] = time.monotonic() + DM_BLOCK_TTL
+                        self.stats["failed"] += 1
+                    else:
+                        await user.send(**kwargs)
+                        ok = True
+                        self.stats["sent"] += 1
+            except discord.Forbidden:
+                self.blocked[uid] = time.monotonic() + DM_BLOCK_TTL
+                self.stats["failed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"[dm] {uid}:", e)
+            ms = (time.perf_counter() - t0) * 1000
+            self.stats["last_ms"] = ms; self.stats["max_ms"] = max(self.stats["max_ms"], ms); self.stats["total_ms"] += ms
+            if not fut.done(): fut.set_result(ok)
+            if on_done:
+                try: await on_done(ok)
+                except Exception: pass
+            self.queue.task_done()
+
+    def info(self) -> Dict[str, Any]:
+        done = self.stats["sent"] + self.stats["failed"]
+        return {"workers": self.workers, "depth": self.queue.qsize(), "blocked": len(self.blocked), **self.stats,
+                "avg_ms": self.stats["total_ms"] / max(1, done)}
+
+DMS = DmService()
+
 # =================== on_message: XP + Bugs + Ticket logging + AntiPing ===================
+# Cada etapa es independiente: corren en paralelo por mensaje, con timeout y métricas propias.
+MESSAGE_STAGE_TIMEOUT = 15.0
+MESSAGE_STAGES: List[tuple] = []  # (nombre, corrutina(message))
+STAGE_STATS: Dict[str, Dict[str, float]] = {}
+
+def message_stage(name: str):
+    def deco(fn):
+        MESSAGE_STAGES.append((name, fn))
+        STAGE_STATS[name] = {"calls": 0, "errors": 0, "timeouts": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+        return fn
+    return deco
+
+async def run_message_stage(name: str, fn, message: discord.Message):
+    st = STAGE_STATS[name]; t0 = time.perf_counter()
+    try: await asyncio.wait_for(fn(message), MESSAGE_STAGE_TIMEOUT)
+    except asyncio.TimeoutError: st["timeouts"] += 1
+    except Exception: st["errors"] += 1
+    ms = (time.perf_counter() - t0) * 1000
+    st["calls"] += 1; st["last_ms"] = ms; st["total_ms"] += ms; st["max_ms"] = max(st["max_ms"], ms)
+
+@message_stage("antiping")
+async def stage_antiping(message: discord.Message):
+    protected = await db.antiping_protected(message.guild.id) if message.mentions else None
+    if not protected: return
+    offenders_member = message.guild.get_member(message.author.id)
+    if offenders_member and offenders_member.guild_permissions.administrator: return
+    hit = any(u.id in protected for u in message.mentions if not u.bot)
+    if not hit: return
+    s = await db.antiping_get_settings(message.guild.id)
+    action = await db.antiping_record(message.guild.id, message.author.id, s["window_hours"], s["threshold"])
+    if action == "warn":
+        DISPATCH.reply(message, PRIO_MOD, embed=brand_embed("🚫 Evita pings","Ese usuario **no desea ser etiquetado**. Si vuelves a hacerlo, serás sancionado.", COLORS["warn"]), mention_author=False)
+    else:
+        try:
+            await timeout_member(message.author, s["timeout_minutes"], "Anti-Ping: mencionó a protegido")
+            DISPATCH.reply(message, PRIO_MOD, embed=brand_embed("🔇 Sanción aplicada", f"Has sido muteado **{s['timeout_minutes']}m**.", COLORS["error"]), mention_author=False)
+        except Exception: pass
+
+@message_stage("tickets")
+async def stage_ticket_log(message: discord.Message):
+    tid = db.ticket_id_for_channel(message.channel.id) if isinstance(message.channel, discord.TextChannel) else None
+    if tid is not None:
+        TICKETS.touch(tid)
+        content = message.content if USE_MSG_INTENT else ""
+        await db.log_ticket_message(message.channel.id, message.author.id, content, [a.url for a in message.attachments] if message.attachments else [],
+                                    author=member_snapshot(message.author))
+
+@message_stage("bugs")
+async def stage_bugs(message: discord.Message):
+    in_id, log_id = await get_bug_ids(message.guild)
+    if message.channel.id != in_id: return
+    if not USE_MSG_INTENT:
+        DISPATCH.send(message.channel, content="⚠️ Activa MESSAGE_CONTENT_INTENT para registrar texto de bugs."); return
+    content = (message.content or "").strip()
+    if not content: return
+    settings = await db.get_bug_settings(message.guild.id)
+    rate = await db.check_bug_rate(message.guild.id, message.author.id, settings["window_hours"])
+    if rate == "warn":
+        try: await message.delete()
+        except Exception: pass
+        DISPATCH.send(message.channel, PRIO_MOD, content=message.author.mention, embed=brand_embed("⛔ Ya registraste un bug", f"No puedes volver a registrar dentro de **{settings['window_hours']}h**.", COLORS["warn"]), delete_after=10, allowed_mentions=discord.AllowedMentions(users=[message.author]))
+        return
+    elif rate == "mute":
+        try: await timeout_member(message.author, settings["mute_minutes"], "Spam de bug reports")
+        except Exception: pass
+        try: await message.delete()
+        except Exception: pass
+        DISPATCH.send(message.channel, PRIO_MOD, content=message.author.mention, embed=brand_embed("🔇 Mute por spam de bugs", f"Has sido muteado **{settings['mute_minutes']}m**.", COLORS["error"]), delete_after=15, allowed_mentions=discord.AllowedMentions(users=[message.author]))
+        return
+    bug = await db.add_bug_report(message.guild.id, message.author.id, message.channel.id, message.id, content)
+    # Echo al usuario
+    DISPATCH.reply(message, embed=brand_embed("🐞 Bug registrado", f"ID: **#{bug['id']}** — Gracias {message.author.mention}.", COLORS["success"]), mention_author=False)
+    # Registro en canal de log
+    log_ch = message.guild.get_channel(log_id)
+    if isinstance(log_ch, discord.TextChannel):
+        s = await db.get_bug_settings(message.guild.id)
+        ping = None
+        if s["ping_mode"] == "here": ping = "@here"
+        elif s["ping_mode"] == "everyone": ping = "@everyone"
+        elif s["ping_mode"] == "staff":
+            role = await resolve_staff_role(message.guild)
+            ping = role.mention if role else None
+        e = brand_embed("🐞 Nuevo bug", f"**#{bug['id']}** por {message.author.mention}\nCanal: {message.channel.mention}\n\n> {content[:180]}{'…' if len(content)>180 else ''}", COLORS["warn"])
+        DISPATCH.send(log_ch, content=ping, embed=e, allowed_mentions=discord.AllowedMentions(everyone=True, roles=True),
+                      on_sent=lambda reg: db.set_bug_registry_message(bug["id"], log_ch.id, reg.id))
+
+@message_stage("xp")
+async def stage_xp(message: discord.Message):
+    # XP por mensaje + anuncio de subida
+    leveled = await levels_gain_xp(message.guild.id, message.author.id, base_xp=random.randint(8,14))
+    if leveled:
+        ch = message.guild.get_channel(LEVEL_UP_CHANNEL_ID)
+        if isinstance(ch, discord.TextChannel):
+            DISPATCH.levelup(ch, message.author.id, leveled)
+
 @client.event
 async def on_message(message: discord.Message):
     if message.author.bot or not message.guild: return
+    await asyncio.gather(*(run_message_stage(name, fn, message) for name, fn in MESSAGE_STAGES))
 
-    # Anti-Ping
-    try:
-        protected = set(await db.antiping_list(message.guild.id))
-        if protected and message.mentions:
-            offenders_member = message.guild.get_member(message.author.id)
-            if offenders_member and offenders_member.guild_permissions.administrator: pass
-            else:
-                hit = any(u.id in protected for u in message.mentions if not u.bot)
-                if hit:
-                    s = await db.antiping_get_settings(message.guild.id)
-                    action = await db.antiping_record(message.guild.id, message.author.id, s["window_hours"], s["threshold"])
-                    if action == "warn":
-                        await message.reply(embed=brand_embed("🚫 Evita pings","Ese usuario **no desea ser etiquetado**. Si vuelves a hacerlo, serás sancionado.", COLORS["warn"]), mention_author=False)
-                    else:
-                        try:
-                            await timeout_member(message.author, s["timeout_minutes"], "Anti-Ping: mencionó a protegido")
-                            await message.reply(embed=brand_embed("🔇 Sanción aplicada", f"Has sido muteado **{s['timeout_minutes']}m**.", COLORS["error"]), mention_author=False)
-                        except Exception: pass
-    except Exception: pass
+# ======= Schedulers =======
+TICKET_WARN_MIN = (30, 10)   # avisos antes del cierre automático
+TICKET_SCHED_IDLE_S = 600    # tope de espera sin plazos, para notar el cierre del cliente
+TICKET_SCHED_RETRY_S = 120   # reintento de un aviso o cierre que falló
 
-    # Ticket logging
-    try:
-        if isinstance(message.channel, discord.TextChannel):
-            content = message.content if USE_MSG_INTENT else ""
-            await db.log_ticket_message(message.channel.id, message.author.id, content, [a.url for a in message.attachments] if message.attachments else [])
-    except Exception: pass
+class TicketScheduler:
+    """Plazos de inactividad en un min-heap: se duerme hasta el más próximo y solo se consulta al usuario cuando un aviso o cierre vence."""
+    def __init__(self):
+        self.tickets: Dict[int, dict] = {}   # ticket_id -> {channel_id, opener_id, last, warned, gen}
+        self.heap: List[tuple] = []          # (vence_ts, ticket_id, gen, evento) con evento = minutos restantes (0 = cierre)
+        self.wake = asyncio.Event()
+        self._gen = 0
+        self.stats = {"tracked": 0, "fired_warn": 0, "fired_close": 0, "rearmed": 0, "stale": 0, "retries": 0}
+
+    @staticmethod
+    def _due(st: dict, ev: int) -> float:
+        return st["last"] + (TICKET_INACTIVE_MIN - ev) * 60
+
+    def track(self, ticket_id: int, channel_id: int, opener_id: int, last_activity: Optional[datetime] = None,
+              warned_30: bool = False, warned_10: bool = False):
+        self._gen += 1
+        st = {"channel_id": int(channel_id), "opener_id": int(opener_id),
+              "last": last_activity.timestamp() if last_activity else time.time(),
+              "warned": {30: bool(warned_30), 10: bool(warned_10)}, "gen": self._gen}
+        self.tickets[int(ticket_id)] = st
+        for ev in (*TICKET_WARN_MIN, 0):
+            if ev and st["warned"][ev]: continue
+            heapq.heappush(self.heap, (self._due(st, ev), int(ticket_id), st["gen"], ev))
+        self.stats["tracked"] += 1
+        self.wake.set()
+
+    def track_row(self, t: Dict):
+        self.track(t["id"], t["channel_id"], t["opener_id"], t["last_activity"], t["warned_30"], t["warned_10"])
+
+    def untrack(self, ticket_id: int):
+        self.tickets.pop(int(ticket_id), None)  # sus entradas del heap quedan huérfanas y se descartan al salir
+
+    def touch(self, ticket_id: int):
+        # los plazos solo se alejan con actividad: basta con mover "last"; la entrada del heap se rearma al vencer
+        st = self.tickets.get(ticket_id)
+        if st: st["last"] = time.time()
 
-    # Bugs auto
-    try:
-        in_id, log_id = await get_bug_ids(message.guild)
-        if message.channel.id == in_id:
-            if not USE_MSG_INTENT:
-                await message.channel.send("⚠️ Activa MESSAGE_CONTENT_INTENT para registrar texto de bugs."); return
-            content = (message.content or "").strip()
-            if not content: return
-            settings = await db.get_bug_settings(message.guild.id)
-            rate = await db.check_bug_rate(message.guild.id, message.author.id, settings["window_hours"])
-            if rate == "warn":
-                try: await message.delete()
-                except Exception: pass
-                await message.channel.send(content=message.author.mention, embed=brand_embed("⛔ Ya registraste un bug", f"No puedes volver a registrar dentro de **{settings['window_hours']}h**.", COLORS["warn"]), delete_after=10, allowed_mentions=discord.AllowedMentions(users=[message.author]))
-                return
-            elif rate == "mute":
-                try: await timeout_member(message.author, settings["mute_minutes"], "Spam de bug reports")
-                except Exception: pass
-                try: await message.delete()
-                except Exception: pass
-                await message.channel.send(content=message.author.mention, embed=brand_embed("🔇 Mute por spam de bugs", f"Has sido muteado **{settings['mute_minutes']}m**.", COLORS["error"]), delete_after=15, allowed_mentions=discord.AllowedMentions(users=[message.author]))
-                return
-            bug = await db.add_bug_report(message.guild.id, message.author.id, message.channel.id, message.id, content)
-            # Echo al usuario
-            await message.reply(embed=brand_embed("🐞 Bug registrado", f"ID: **#{bug['id']}** — Gracias {message.author.mention}.", COLORS["success"]), mention_author=False)
-            # Registro en canal de log
-            log_ch = message.guild.get_channel(log_id)
-            if isinstance(log_ch, discord.TextChannel):
-                s = await db.get_bug_settings(message.guild.id)
-                ping = None
-                if s["ping_mode"] == "here": ping = "@here"
-                elif s["ping_mode"] == "everyone": ping = "@everyone"
-                elif s["ping_mode"] == "staff":
-                    role = await resolve_staff_role(message.guild)
-                    ping = role.mention if role else None
-                e = brand_embed("🐞 Nuevo bug", f"**#{bug['id']}** por {message.author.mention}\nCanal: {message.channel.mention}\n\n> {content[:180]}{'…' if len(content)>180 else ''}", COLORS["warn"])
-                reg = await log_ch.send(content=ping, embed=e, allowed_mentions=discord.AllowedMentions(everyone=True, roles=True))
-                await db.set_bug_registry_message(bug["id"], log_ch.id, reg.id)
-    except Exception: pass
+    async def run(self):
+        await client.wait_until_ready()
+        try:
+            for t in await db.list_open_tickets(): self.track_row(t)
+        except Exception as e:
+            print("[tickets] no pude cargar tickets abiertos:", e)
+        while not client.is_closed():
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                _, tid, gen, ev = heapq.heappop(self.heap)
+                st = self.tickets.get(tid)
+                if not st or st["gen"] != gen:
+                    self.stats["stale"] += 1; continue
+                due = self._due(st, ev)
+                if due > now:  # hubo actividad desde que se programó
+                    heapq.heappush(self.heap, (due, tid, gen, ev)); self.stats["rearmed"] += 1; continue
+                try:
+                    if ev: await self._warn(tid, st, ev)
+                    else: await self._close(tid, st)
+                except Exception as e:
+                    print(f"[tickets] plazo fallido en #{tid}:", e)
+                    self._retry(tid, gen, ev)
+            self.wake.clear()
+            timeout = min(self.heap[0][0] - time.time(), TICKET_SCHED_IDLE_S) if self.heap else TICKET_SCHED_IDLE_S
+            try: await asyncio.wait_for(self.wake.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError: pass
+
+    def _retry(self, tid: int, gen: int, ev: int):
+        st = self.tickets.get(tid)
+        if not st or st["gen"] != gen: return
+        if ev: st["warned"][ev] = False
+        heapq.heappush(self.heap, (time.time() + TICKET_SCHED_RETRY_S, tid, gen, ev))
+        self.stats["retries"] += 1
+        self.wake.set()
+
+    async def _warn(self, tid: int, st: dict, minutes: int):
+        if st["warned"][minutes]: return
+        st["warned"][minutes] = True
+        self.stats["fired_warn"] += 1
+        async def mark(ok: bool):
+            if ok: await db.mark_warning(tid, minutes)
+        await DMS.send(st["opener_id"], on_done=mark,
+                       embed=brand_embed("⏳ Inactividad", f"Te quedan **{minutes} minutos** para responder tu ticket.", COLORS["warn"]))
+
+    async def _close(self, tid: int, st: dict):
+        # confirmar contra la base antes de cerrar: puede haberse cerrado a mano o tener actividad de otro proceso
+        t = await db.fetch_ticket_by_channel(st["channel_id"])
+        if not t or t["status"] != "open" or int(t["id"]) != tid:
+            self.untrack(tid); return
+        st["last"] = max(st["last"], t["last_activity"].timestamp())
+        if self._due(st, 0) > time.time():
+            heapq.heappush(self.heap, (self._due(st, 0), tid, st["gen"], 0)); self.stats["rearmed"] += 1; return
+        ch = client.get_channel(st["channel_id"])
+        if not isinstance(ch, discord.TextChannel):
+            self._retry(tid, st["gen"], 0); return
+        self.stats["fired_close"] += 1
+        # no esperar el resultado: el cierre corre en los workers y el heap sigue atendiendo otros plazos.
+        # El pipeline quita el ticket del scheduler al cerrarlo en la DB; si falla antes, se reintenta.
+        fut = await TICKET_CLOSER.submit(ch, client.user.id, "Cierre automático por inactividad", auto=True)
+        gen = st["gen"]
+        fut.add_done_callback(lambda f: None if f.result() else self._retry(tid, gen, 0))
+
+    def info(self) -> Dict[str, Any]:
+        return {"open": len(self.tickets), "heap": len(self.heap),
+                "next_in_s": round(self.heap[0][0] - time.time(), 1) if self.heap else None, **self.stats}
+
+TICKETS = TicketScheduler()
+
+async def ticket_log_flusher():
+    while not client.is_closed():
+        await asyncio.sleep(db.tmsg_flush_interval)
+        try: await db.flush_ticket_messages()
+        except Exception: pass
 
-    # XP por mensaje + anuncio de subida
-    try:
-        leveled = await levels_gain_xp(message.guild.id, message.author.id, base_xp=random.randint(8,14))
-        if leveled:
-            ch = message.guild.get_channel(LEVEL_UP_CHANNEL_ID)
-            if isinstance(ch, discord.TextChannel):
-                await ch.send(embed=brand_embed("🆙 ¡Subiste de nivel!", f"{message.author.mention} ahora es **Nivel {leveled}** 🎉", COLORS["success"]))
-    except Exception:
-        pass
+TICKET_MAINTENANCE_INTERVAL = 6 * 3600
 
-# ======= Schedulers =======
-async def ticket_watcher():
+async def ticket_partition_maintainer():
+    # crea las particiones de los meses siguientes y aplica la retención a las ya vencidas
+    if not db.partition_ticket_messages: return
     await client.wait_until_ready()
     while not client.is_closed():
         try:
-            open_ts = await db.list_open_tickets()
-            nowts = time.time()
-            for t in open_ts:
-                last = t["last_activity"].timestamp()
-                mins = int((nowts - last) / 60)
-                try: user = await client.fetch_user(t["opener_id"])
-                except Exception: user = None
-                if mins >= (TICKET_INACTIVE_MIN - 30) and not t["warned_30"] and user:
-                    try: await user.send(embed=brand_embed("⏳ Inactividad","Te quedan **30 minutos** para responder tu ticket.", COLORS["warn"])); await db.mark_warning(t["id"], 30)
-                    except Exception: pass
-                if mins >= (TICKET_INACTIVE_MIN - 10) and not t["warned_10"] and user:
-                    try: await user.send(embed=brand_embed("⏳ Inactividad","Te quedan **10 minutos** para responder tu ticket.", COLORS["warn"])); await db.mark_warning(t["id"], 10)
-                    except Exception: pass
-                if mins >= TICKET_INACTIVE_MIN:
-                    ch = client.get_channel(t["channel_id"])
-                    if isinstance(ch, discord.TextChannel):
-                        data = await db.close_ticket_by_channel(ch.id, closed_by=client.user.id, reason="Cierre automático por inactividad")
-                        if data:
-                            tinfo, messages = data
-                            lines = []
-                            for m in messages:
-                                stamp = m["created_at"].strftime("%Y-%m-%d %H:%M:%S")
-                                content = m["content"] or ""
-                                atts = m["attachments"] or []
-                                if atts: content += " " + " ".join(atts)
-                                lines.append(f"[{stamp}] ({m['author_id']}): {content}")
-                            txt = "\n".join(lines) if lines else "No hubo mensajes."
-                            file_txt = discord.File(io.BytesIO(txt.encode()), filename=f"ticket_{tinfo['id']}_transcript.txt")
-                            opener_name = await fetch_member_name(ch.guild, tinfo["opener_id"])
-                            html_bytes = await render_transcript_html(ch.guild, tinfo, messages, opener_name, USE_MSG_INTENT)
-                            file_html = discord.File(io.BytesIO(html_bytes), filename=f"ticket_{tinfo['id']}_transcript.html")
-                            await ch.send(embed=brand_embed("🛑 Ticket cerrado por inactividad (3h)", color=COLORS["error"]), files=[file_txt, file_html])
-                            await apply_closed_effects(ch, int(tinfo["opener_id"]))
-                            try:
-                                if user:
-                                    await user.send(embed=brand_embed("Tu ticket fue cerrado por inactividad", color=COLORS["info"]))
-                                    await user.send(files=[discord.File(io.BytesIO(txt.encode()), filename=f"ticket_{tinfo['id']}.txt"),
-                                                           discord.File(io.BytesIO(html_bytes), filename=f"ticket_{tinfo['id']}.html")])
-                            except Exception: pass
+            await db.ensure_ticket_partitions()
+            if TICKET_MSG_RETENTION_DAYS > 0:
+                for p in await db.expired_ticket_partitions(TICKET_MSG_RETENTION_DAYS):
+                    ok = True
+                    for tid in p["unarchived"]:  # archivar la transcripción antes de perder los mensajes
+                        t = await db.fetch_ticket(tid)
+                        guild = client.get_guild(int(t["guild_id"])) if t else None
+                        # sin guild en caché no se puede renderizar: la partición espera al próximo ciclo
+                        try: archived = guild is not None and await load_transcript(guild, tid) is not None
+                        except Exception as e:
+                            archived = False; print(f"[tickets] no pude archivar #{tid} antes de la retención:", e)
+                        if not archived: ok = False
+                    if not ok: continue
+                    await db.drop_ticket_partition(p["name"], detach=TICKET_MSG_RETENTION_DETACH)
+                    print(f"[tickets] retención: {'desacoplada' if TICKET_MSG_RETENTION_DETACH else 'borrada'} {p['name']}")
+        except Exception as e:
+            print("[tickets] mantenimiento de particiones:", e)
+        await asyncio.sleep(TICKET_MAINTENANCE_INTERVAL)
+
+async def giveaway_entry_flusher():
+    while not client.is_closed():
+        await asyncio.sleep(db.gw_flush_interval)
+        try: await db.flush_giveaway_entries()
+        except Exception: pass
+
+async def xp_flusher():
+    while not client.is_closed():
+        await asyncio.sleep(XP_FLUSH_INTERVAL)
+        try: await XP.flush()
         except Exception: pass
-        await asyncio.sleep(300)
 
 # ======= GIVEAWAYS =======
 class GiveawayEnterView(discord.ui.View):
@@ -1162,10 +1862,61 @@ class GiveawayEnterView(discord.ui.View):
         self.giveaway_id = giveaway_id
     @discord.ui.button(label="🎉 Participar", style=discord.ButtonStyle.success, custom_id="gw_enter")
     async def enter(self, inter: discord.Interaction, button: discord.ui.Button):
-        ok = await db.giveaway_enter(self.giveaway_id, inter.user.id)
-        if ok: await inter.response.send_message("✅ ¡Estás dentro!", ephemeral=True)
+        # la vista persistente registrada al arrancar no conoce el id: se resuelve por el mensaje
+        gid = self.giveaway_id or await db.giveaway_id_for_message(inter.message.id)
+        ok = bool(gid) and await db.giveaway_enter(gid, inter.user.id)
+        if ok:
+            await inter.response.send_message("✅ ¡Estás dentro!", ephemeral=True)
+            GIVEAWAY_COUNTER.bump(gid, inter.message)
         else: await inter.response.send_message("⚠️ No fue posible entrar (quizá ya estabas o terminó).", ephemeral=True)
 
+GIVEAWAY_COUNT_EDIT_S = 5.0
+GIVEAWAY_COUNT_FIELD = "👥 Participantes"
+
+class GiveawayCounter:
+    """Contador de participantes en el anuncio: como mucho una edición cada GIVEAWAY_COUNT_EDIT_S por giveaway."""
+    def __init__(self):
+        self.pending: Dict[int, discord.Message] = {}   # giveaway_id -> anuncio con edición pendiente
+        self.last: Dict[int, float] = {}
+        self.tasks: set = set()
+        self.stats = {"edits": 0, "coalesced": 0}
+
+    def bump(self, giveaway_id: int, message: Optional[discord.Message]):
+        if message is None: return
+        if giveaway_id in self.pending:
+            self.pending[giveaway_id] = message
+            self.stats["coalesced"] += 1
+            return
+        self.pending[giveaway_id] = message
+        t = asyncio.create_task(self._edit_later(giveaway_id))
+        self.tasks.add(t)
+        t.add_done_callback(self.tasks.discard)
+
+    async def _edit_later(self, giveaway_id: int):
+        wait = self.last.get(giveaway_id, 0.0) + GIVEAWAY_COUNT_EDIT_S - time.monotonic()
+        if wait > 0: await asyncio.sleep(wait)
+        msg = self.pending.pop(giveaway_id, None)
+        n = db.giveaway_entrant_count(giveaway_id)
+        if msg is None or not n or not msg.embeds:
+            self.last.pop(giveaway_id, None); return
+        self.last[giveaway_id] = time.monotonic()
+        e = msg.embeds[0].copy()
+        idx = next((i for i, f in enumerate(e.fields) if f.name == GIVEAWAY_COUNT_FIELD), None)
+        if idx is None: e.add_field(name=GIVEAWAY_COUNT_FIELD, value=str(n), inline=True)
+        else: e.set_field_at(idx, name=GIVEAWAY_COUNT_FIELD, value=str(n), inline=True)
+        try:
+            await msg.edit(embed=e)
+            self.stats["edits"] += 1
+        except Exception: pass
+
+GIVEAWAY_COUNTER = GiveawayCounter()
+
+async def find_giveaway(inter: discord.Interaction, message_id: str) -> Optional[Dict]:
+    if not inter.guild: return None
+    try: mid = int(message_id.strip())
+    except ValueError: return None
+    return await db.giveaway_by_message(inter.guild.id, mid)
+
 class GiveawayGroup(app_commands.Group):
     def __init__(self): super().__init__(name="giveaway", description="Sorteos (giveaways)")
     @app_commands.command(name="create", description="Crea un giveaway")
@@ -1183,14 +1934,12 @@ class GiveawayGroup(app_commands.Group):
         ping_text = ping_role.mention if ping_role else None
         msg = await ch.send(content=ping_text, embed=e, view=view, allowed_mentions=discord.AllowedMentions(roles=True))
         await db.giveaway_set_message(gw["id"], msg.id)
+        GIVEAWAYS.schedule(gw["id"], gw["ends_at"])  # sin esperar al NOTIFY
         await inter.response.send_message(f"✅ Giveaway creado en {ch.mention}.", ephemeral=True)
     @app_commands.command(name="end", description="Termina un giveaway ahora")
     @app_commands.default_permissions(manage_guild=True)
     async def end(self, inter: discord.Interaction, message_id: str):
-        rows = await db.giveaway_list(inter.guild.id)
-        target = None
-        for r in rows:
-            if str(r.get("message_id")) == str(message_id): target = r; break
+        target = await find_giveaway(inter, message_id)
         if not target: return await inter.response.send_message("No encontré el giveaway.", ephemeral=True)
         res = await db.giveaway_end(target["id"])
         if not res["ok"]: return await inter.response.send_message("No se pudo terminar.", ephemeral=True)
@@ -1199,13 +1948,10 @@ class GiveawayGroup(app_commands.Group):
     @app_commands.command(name="reroll", description="Vuelve a sortear un giveaway terminado")
     @app_commands.default_permissions(manage_guild=True)
     async def reroll(self, inter: discord.Interaction, message_id: str):
-        rows = await db.giveaway_list(inter.guild.id)
-        target = None
-        for r in rows:
-            if str(r.get("message_id")) == str(message_id): target = r; break
+        target = await find_giveaway(inter, message_id)
         if not target: return await inter.response.send_message("No encontré el giveaway.", ephemeral=True)
-        res = await db.giveaway_end(target["id"])
-        if not res["ok"]: return await inter.response.send_message("No se pudo rerollear.", ephemeral=True)
+        res = await db.giveaway_reroll(target["id"])
+        if not res["ok"]: return await inter.response.send_message("No se pudo rerollear (¿sigue en curso?).", ephemeral=True)
         await announce_giveaway_result(res, reroll=True)
         await inter.response.send_message("✅ Reroll hecho.", ephemeral=True)
     @app_commands.command(name="list", description="Lista giveaways del servidor")
@@ -1235,22 +1981,124 @@ async def announce_giveaway_result(res: Dict, reroll: bool=False):
         except Exception:
             await ch.send(embed=e)
     for uid in winners:
-        try:
-            u = await client.fetch_user(uid)
-            await u.send(embed=brand_embed("🎉 ¡Ganaste!", f"Premio: **{res['prize']}**", COLORS["success"]))
-        except Exception: pass
+        await DMS.send(uid, embed=brand_embed("🎉 ¡Ganaste!", f"Premio: **{res['prize']}**", COLORS["success"]))
 
-async def giveaway_watcher():
-    await client.wait_until_ready()
-    while not client.is_closed():
+GIVEAWAY_LISTEN_RETRY_S = 30
+GIVEAWAY_IDLE_S = 600   # tope de espera sin giveaways, solo para notar el cierre del cliente (sin consultas)
+GIVEAWAY_END_RETRY_S = 15   # primer reintento si falla el fin; se duplica hasta GIVEAWAY_END_RETRY_MAX_S
+GIVEAWAY_END_RETRY_MAX_S = 300
+
+class GiveawayScheduler:
+    """Giveaways en curso en un heap por `ends_at`: duerme hasta el próximo fin y se entera de altas y cambios por LISTEN/NOTIFY."""
+    def __init__(self):
+        self.due: Dict[int, float] = {}   # giveaway_id -> ends_ts vigente
+        self.heap: List[tuple] = []       # (ends_ts, giveaway_id); entradas que no coinciden con `due` están vencidas
+        self.ending: set = set()          # ya disparados, terminando: no reprogramar aunque una recarga los vea en curso
+        self.wake = asyncio.Event()
+        self.conn = None
+        self.failures: Dict[int, int] = {}   # giveaway_id -> fallos seguidos al terminar
+        self.tasks: set = set()              # referencias fuertes a las tareas sueltas
+        self.stats = {"fired": 0, "notifies": 0, "reloads": 0, "listen_errors": 0, "end_errors": 0}
+
+    def _spawn(self, coro):
+        t = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(t)
+        t.add_done_callback(self.tasks.discard)
+
+    def schedule(self, giveaway_id: int, ends_at):
+        ts = ends_at.timestamp() if isinstance(ends_at, datetime) else float(ends_at)
+        if giveaway_id in self.ending or self.due.get(giveaway_id) == ts: return
+        self.due[giveaway_id] = ts
+        heapq.heappush(self.heap, (ts, giveaway_id))
+        self.wake.set()
+
+    def unschedule(self, giveaway_id: int):
+        self.due.pop(giveaway_id, None)
+
+    def _on_notify(self, payload: str):
+        self.stats["notifies"] += 1
+        try: self._spawn(self._refresh(int(payload)))
+        except ValueError: pass
+
+    def _on_lost(self):
+        self.conn = None
+        self.wake.set()
+
+    async def _refresh(self, giveaway_id: int):
+        try: gw = await db.giveaway_get(giveaway_id)
+        except Exception: return
+        if gw and gw["status"] == "running": self.schedule(giveaway_id, gw["ends_at"])
+        else:
+            self.unschedule(giveaway_id)
+            db.giveaway_cache_status(giveaway_id, gw["status"] if gw else "missing")  # p. ej. terminado desde otro proceso
+
+    async def _connect(self) -> bool:
+        """Abre el LISTEN y recarga el heap; sin LISTEN se recarga igual (y se reintenta cada GIVEAWAY_LISTEN_RETRY_S)."""
+        listening = True
         try:
-            due = await db.giveaway_list_due()
-            for gw in due:
-                res = await db.giveaway_end(gw["id"])
-                if res.get("ok"):
-                    await announce_giveaway_result(res)
-        except Exception: pass
-        await asyncio.sleep(20)
+            self.conn = await db.listen("giveaways", self._on_notify, on_lost=self._on_lost)
+        except Exception as e:
+            self.stats["listen_errors"] += 1
+            print("[giveaways] LISTEN no disponible:", e)
+            listening = False
+        # recargar después de escuchar: lo que cambió mientras no escuchábamos queda cubierto
+        try: rows = await db.giveaway_list_running()
+        except Exception as e:
+            print("[giveaways] no pude cargar los giveaways en curso:", e)
+            if self.conn: await self.conn.close(); self.conn = None
+            return False
+        self.due.clear(); self.heap.clear()
+        for r in rows: self.schedule(int(r["id"]), r["ends_at"])
+        self.stats["reloads"] += 1
+        return listening
+
+    async def _end(self, giveaway_id: int):
+        self.ending.add(giveaway_id)
+        try:
+            res = await db.giveaway_end(giveaway_id)
+        except Exception as e:
+            # sigue 'running' en la DB: reprogramar con backoff en vez de esperar a un reinicio
+            n = self.failures[giveaway_id] = self.failures.get(giveaway_id, 0) + 1
+            backoff = min(GIVEAWAY_END_RETRY_MAX_S, GIVEAWAY_END_RETRY_S * 2 ** (n - 1))
+            self.stats["end_errors"] += 1
+            print(f"[giveaways] no pude terminar #{giveaway_id} (reintento en {backoff}s):", e)
+            self.ending.discard(giveaway_id)
+            self.schedule(giveaway_id, time.time() + backoff)
+            return
+        self.failures.pop(giveaway_id, None)
+        try:
+            if res.get("ok"):
+                self.stats["fired"] += 1
+                await announce_giveaway_result(res)
+        except Exception as e:
+            print(f"[giveaways] no pude anunciar #{giveaway_id}:", e)
+        finally:
+            self.ending.discard(giveaway_id)
+
+    async def run(self):
+        await client.wait_until_ready()
+        retry_at = 0.0
+        while not client.is_closed():
+            now = time.time()
+            if (self.conn is None or self.conn.is_closed()) and now >= retry_at:
+                if not await self._connect(): retry_at = now + GIVEAWAY_LISTEN_RETRY_S
+            while self.heap and self.heap[0][0] <= now:
+                ts, gid = heapq.heappop(self.heap)
+                if self.due.get(gid) != ts: continue
+                del self.due[gid]
+                self._spawn(self._end(gid))  # varios giveaways que terminan juntos no se esperan entre sí
+            self.wake.clear()
+            timeout = GIVEAWAY_IDLE_S
+            if self.heap: timeout = min(timeout, self.heap[0][0] - time.time())
+            if self.conn is None: timeout = min(timeout, max(1.0, retry_at - time.time()))
+            try: await asyncio.wait_for(self.wake.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError: pass
+
+    def info(self) -> Dict[str, Any]:
+        return {"running": len(self.due), "heap": len(self.heap), "listening": self.conn is not None and not self.conn.is_closed(),
+                "next_in_s": round(min(self.due.values()) - time.time(), 1) if self.due else None, **self.stats}
+
+GIVEAWAYS = GiveawayScheduler()
 
 # ========================= TRIVIA =========================
 class TriviaFetcher:
@@ -1543,10 +2391,19 @@ async def on_ready():
 async def main_async():
     global db
     if not TOKEN: raise SystemExit("❌ Falta DISCORD_TOKEN")
-    db = Database(DATABASE_URL); await db.connect(); await db.init()
+    db = Database(DATABASE_URL, partition_ticket_messages=TICKET_MSG_PARTITIONED, listen_dsn=DATABASE_LISTEN_URL); await db.connect(); await db.init(); await db.warm_ticket_index()
+    db.config_listeners.append(GUILD_META.invalidate)
+    try: await db.load_key_filter()
+    except Exception as e: print("Key filter error:", e)
     try:
-        await asyncio.gather(run_web(), client.start(TOKEN), ticket_watcher(), giveaway_watcher())
+        await asyncio.gather(run_web(), client.start(TOKEN), TICKETS.run(), TICKET_CLOSER.run(), DMS.run(), GIVEAWAYS.run(), ticket_log_flusher(), xp_flusher(), giveaway_entry_flusher(),
+                             ticket_partition_maintainer())
     finally:
+        try: await XP.flush()
+        except Exception: pass
+        if GIVEAWAYS.conn:
+            try: await GIVEAWAYS.conn.close()
+            except Exception: pass
         await db.close(); await TRIVIA_FETCHER.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import asyncio, os, random, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("asyncpg")
+from db import AliasSampler, Database
+
+N = 200_000
+# valor crítico de chi-cuadrado para p = 0.001 según grados de libertad
+CHI2_CRIT_001 = {1: 10.83, 2: 13.82, 3: 16.27, 4: 18.47, 5: 20.52, 9: 27.88}
+
+def chi_square(weights, seed=1234):
+    items = list(range(len(weights)))
+    sampler = AliasSampler(items, weights)
+    rng = random.Random(seed)
+    counts = [0] * len(items)
+    for _ in range(N):
+        counts[sampler.draw(rng)] += 1
+    total = float(sum(weights))
+    stat, df = 0.0, -1
+    for c, w in zip(counts, weights):
+        if w == 0:
+            assert c == 0  # peso 0: nunca sale
+            continue
+        exp = N * w / total
+        stat += (c - exp) ** 2 / exp
+        df += 1
+    return stat, df
+
+@pytest.mark.parametrize("weights", [
+    [1, 2, 3, 4],
+    [1] * 10,
+    [100, 1, 1, 0.5, 10],
+    [0.25, 0, 3, 0, 7.5],
+    [5, 1],
+])
+def test_draw_distribution(weights):
+    stat, df = chi_square(weights)
+    assert stat < CHI2_CRIT_001[df], (stat, df)
+
+def test_single_and_empty():
+    assert AliasSampler(["a"], [3]).draw() == "a"
+    assert len(AliasSampler([], [])) == 0
+
+class FakePrizePool:
+    def __init__(self): self.selects = 0
+    def acquire(self): return self
+    async def __aenter__(self): return self
+    async def __aexit__(self, *a): return False
+    async def fetch(self, sql, *a):
+        self.selects += 1
+        await asyncio.sleep(0.01)
+        return [{"name": "A", "description": "", "weight": 3}, {"name": "B", "description": "", "weight": 1}]
+
+def test_prize_sampler_single_flight():
+    async def run():
+        db = Database("")
+        db.pool = FakePrizePool()
+        samplers = await asyncio.gather(*(db._get_prize_sampler() for _ in range(50)))
+        assert db.pool.selects == 1 and all(s is samplers[0] for s in samplers)
+        db._invalidate_prizes()
+        await asyncio.gather(*(db._get_prize_sampler() for _ in range(50)))
+        assert db.pool.selects == 2 and db.prize_sampler_builds == 2
+    asyncio.run(run())
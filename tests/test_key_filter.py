@@ -0,0 +1,107 @@
+import asyncio, os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("asyncpg")
+import db as dbmod
+from db import BloomFilter, Database
+
+def test_bloom_no_false_negatives_and_fp_rate():
+    bf = BloomFilter(20_000)
+    members = [f"KEY-{i:06d}" for i in range(20_000)]
+    for m in members: bf.add(m)
+    assert all(m in bf for m in members)
+    probes = 100_000
+    fp = sum(f"OTHER-{i}" in bf for i in range(probes)) / probes
+    # lleno hasta su capacidad, el ratio medido debe rondar el configurado
+    assert fp < 2 * bf.fp_rate, fp
+
+def test_check_keys_rejects_without_db():
+    async def run():
+        db = Database("")
+        db._key_filter = BloomFilter(1_000)
+        db._key_filter.add("AAAA-BBBB-CCCC")
+        calls = []
+        async def redeem_known(uniq, user_id):
+            calls.append(list(uniq))
+            return {c: {"ok": True} for c in uniq}
+        db._redeem_known = redeem_known
+        out = await db.check_keys(["ZZZZ-ZZZZ-ZZZZ", "AAAA-BBBB-CCCC", "YYYY-YYYY-YYYY"], 1)
+        assert out == [{"ok": False, "reason": "not_found"}, {"ok": True}, {"ok": False, "reason": "not_found"}]
+        assert calls == [["AAAA-BBBB-CCCC"]]
+        assert db.key_filter_stats["rejected"] == 2 and db.key_filter_stats["passed"] == 1
+        # todo descartado: ni un viaje a la DB
+        await db.check_keys(["QQQQ-QQQQ-QQQQ"], 1)
+        assert len(calls) == 1
+    asyncio.run(run())
+
+class FakeKeysConn:
+    """Tabla keys en memoria: lo insertado en una transacción solo se ve (cursor/COUNT) al confirmarse."""
+    def __init__(self, store): self.store, self.uncommitted = store, []
+    def transaction(self): return FakeTx(self)
+    async def fetch(self, sql, codes, *a):
+        self.store.inserts += 1
+        if self.store.inserts == 2:  # segunda tanda: esperar a que la reconstrucción corra en medio
+            self.store.mid_tx.set()
+            await self.store.release.wait()
+        self.uncommitted.extend(codes)
+        self.store.writer = self
+        return [{"code": c} for c in codes]
+    async def fetchval(self, sql, *a): return len(self.store.committed)
+    async def cursor(self, sql, prefetch=None):
+        for c in list(self.store.committed): yield {"code": c}
+
+class FakeTx:
+    def __init__(self, conn): self.conn = conn
+    async def __aenter__(self): pass
+    async def __aexit__(self, exc_type, *a):
+        if exc_type is None: self.conn.store.committed.extend(self.conn.uncommitted)
+        self.conn.uncommitted = []
+        return False
+
+class FakeKeysPool:
+    def __init__(self):
+        self.committed, self.inserts, self.writer = [], 0, None
+        self.mid_tx, self.release = asyncio.Event(), asyncio.Event()
+    def acquire(self): return FakeAcquire(FakeKeysConn(self))
+
+class FakeAcquire:
+    def __init__(self, conn): self.conn = conn
+    async def __aenter__(self): return self.conn
+    async def __aexit__(self, *a): return False
+
+def test_insert_remembers_codes_and_rebuild_keeps_inflight(monkeypatch):
+    monkeypatch.setattr(dbmod, "KEY_INSERT_CHUNK", 50)
+    async def run():
+        db = Database("")
+        db.pool = FakeKeysPool()
+        await db.load_key_filter()
+        create = asyncio.create_task(db.create_keys(100, "random", None, 1, None))
+        await db.pool.mid_tx.wait()
+        first = list(db.pool.writer.uncommitted)
+        assert len(first) == 50 and all(c in db._key_filter for c in first)
+        assert db._key_inflight and first[0] in db._key_inflight[0]
+        # reconstrucción en plena transacción: el cursor no ve la primera tanda, pero el filtro nuevo sí debe tenerla
+        await db.load_key_filter()
+        assert db.pool.committed == []
+        assert all(c in db._key_filter for c in first)
+        db.pool.release.set()
+        res = await create
+        assert res["ok"] and len(res["codes"]) == 100
+        assert all(c in db._key_filter for c in res["codes"])
+        assert db._key_inflight == []
+    asyncio.run(run())
+
+def test_failed_rebuild_is_logged(capsys):
+    async def run():
+        db = Database("")
+        db._key_filter = BloomFilter(1)
+        async def broken(): raise RuntimeError("sin conexión")
+        db.load_key_filter = broken
+        db._remember_codes(["AAAA-BBBB-CCCC", "DDDD-EEEE-FFFF"])
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert db.key_filter_stats["build_errors"] == 1
+        assert "AAAA-BBBB-CCCC" in db._key_filter
+    asyncio.run(run())
+    assert "no pude reconstruir el filtro" in capsys.readouterr().out
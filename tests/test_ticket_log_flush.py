@@ -0,0 +1,77 @@
+import asyncio, os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+asyncpg = pytest.importorskip("asyncpg")
+from db import Database
+
+BAD_TICKET = 13
+
+class FakeConn:
+    """Conexión mínima: COPY rechaza (como una FK rota) cualquier lote que traiga filas de BAD_TICKET."""
+    def __init__(self, pool): self.pool = pool
+    def transaction(self): return FakeTx(self)
+    async def copy_records_to_table(self, table, records, columns):
+        self.pool.copies += 1
+        if any(r[0] == BAD_TICKET for r in records):
+            raise asyncpg.ForeignKeyViolationError("ticket borrado")
+        self.pool.pending.extend(records)
+    async def execute(self, *a): pass
+
+class FakeTx:
+    def __init__(self, conn): self.conn = conn
+    async def __aenter__(self): self.conn.pool.pending = []
+    async def __aexit__(self, exc_type, *a):
+        if exc_type is None: self.conn.pool.written.extend(self.conn.pool.pending)
+        return False
+
+class FakePool:
+    def __init__(self): self.written, self.pending, self.copies = [], [], 0
+    def acquire(self): return FakeAcquire(FakeConn(self))
+
+class FakeAcquire:
+    def __init__(self, conn): self.conn = conn
+    async def __aenter__(self): return self.conn
+    async def __aexit__(self, *a): return False
+
+def make_db():
+    db = Database("postgres://test")
+    db.pool = FakePool()
+    db._open_tickets = {100: 1, 200: BAD_TICKET, 300: 3}
+    return db
+
+def test_poison_row_does_not_block_later_rows():
+    async def run():
+        db = make_db()
+        for i in range(20):
+            await db.log_ticket_message(100, 1, f"a{i}", [])
+            if i == 7: await db.log_ticket_message(200, 2, "malo", [])
+            await db.log_ticket_message(300, 3, f"c{i}", [])
+        await db.flush_ticket_messages()
+        assert db._tmsg_buf == []
+        assert db.tmsg_stats["rejected"] == 1
+        assert len(db.pool.written) == 40
+        assert all(r[0] != BAD_TICKET for r in db.pool.written)
+        # lo que llega después se vuelca en un solo COPY, sin arrastrar la fila mala
+        copies = db.pool.copies
+        await db.log_ticket_message(100, 1, "después", [])
+        await db.flush_ticket_messages()
+        assert db.pool.copies == copies + 1
+        assert db.pool.written[-1][3] == "después"
+    asyncio.run(run())
+
+def test_transient_error_requeues_rows():
+    async def run():
+        db = make_db()
+        async def boom(*a, **k): raise ConnectionResetError()
+        await db.log_ticket_message(100, 1, "x", [])
+        await db.log_ticket_message(300, 3, "y", [])
+        FakeConn.copy_records_to_table, orig = boom, FakeConn.copy_records_to_table
+        try:
+            with pytest.raises(ConnectionResetError):
+                await db.flush_ticket_messages()
+        finally:
+            FakeConn.copy_records_to_table = orig
+        assert [r[3] for r in db._tmsg_buf] == ["x", "y"]
+        assert db.tmsg_stats["rejected"] == 0
+    asyncio.run(run())
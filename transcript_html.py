@@ -1,5 +1,5 @@
-from typing import List, Dict
-import html, re
+from typing import List, Dict, Tuple, Iterable, BinaryIO, Callable, Optional
+import asyncio, html, io, re
 
 CSS = """
 <!DOCTYPE html>
@@ -43,100 +43,202 @@ FOOT = """
 </div></body></html>
 """
 
+URL_RE = re.compile(r"(https?://[^\s]+)")
+CHUNK_MESSAGES = 500   # mensajes por bloque escrito en la salida
+
 def esc(s:str)->str:
     return html.escape(str(s or ""))
 
 def linkify(text: str) -> str:
-    url_re = re.compile(r"(https?://[^\s]+)")
-    return url_re.sub(r'<a href="\1" target="_blank">\1</a>', esc(text))
-
-async def render_transcript_html(guild, tinfo: Dict, messages: List[Dict], opener_name: str, use_msg_intent: bool) -> bytes:
-    gname = getattr(guild, "name", "Servidor")
-    title = f"Ticket #{tinfo['id']} — {gname}"
-    kind = tinfo.get("kind","?")
-    claimed_by = tinfo.get("claimed_by")
-    opener = opener_name
-
-    parts = [CSS]
-    parts.append(f'<div class="header"><h1>{esc(title)}</h1>')
-    parts.append(f'<span class="pill">Tipo: {esc(kind)}</span>')
-    parts.append(f'<span class="pill">Abierto por: {esc(opener)}</span>')
-    if claimed_by:
-        sname = str(claimed_by)
-        try:
-            staff = guild.get_member(int(claimed_by))
-            if staff:
-                sname = staff.display_name
-        except Exception:
-            pass
-        parts.append(f'<span class="pill">Reclamado por: {esc(sname)}</span>')
-    created_at = tinfo.get("created_at")
-    closed_at = tinfo.get("closed_at") or created_at
+    return URL_RE.sub(r'<a href="\1" target="_blank">\1</a>', esc(text))
+
+def member_snapshot(member) -> Tuple[str, str, bool]:
+    """(nombre visible, avatar, staff) de un miembro: lo que se guarda en ticket_authors al registrar un mensaje."""
+    avatar = ""
     try:
-        c1 = created_at.strftime("%Y-%m-%d %H:%M")
-        c2 = closed_at.strftime("%Y-%m-%d %H:%M")
+        avatar = member.display_avatar.url
     except Exception:
-        c1 = c2 = "—"
-    parts.append(f'<div class="note">Período: {esc(c1)} → {esc(c2)}</div>')
-    if not use_msg_intent:
-        parts.append('<div class="note" style="color:#ffb4b4">⚠️ El bot no tenía Message Content Intent activo: los textos pueden aparecer vacíos.</div>')
-    parts.append('</div>')
-
-    current_day = None
-    for m in messages:
-        ts = m.get("created_at")
-        day_key = ""
-        stamp = ""
-        try:
-            day_key = ts.strftime("%Y-%m-%d")
-            stamp = ts.strftime("%Y-%m-%d %H:%M:%S")
-        except Exception:
-            pass
-        if day_key and day_key != current_day:
-            current_day = day_key
-            parts.append(f'<div class="day">{esc(current_day)}</div>')
+        avatar = ""
+    try:
+        staff = bool(member.guild_permissions.manage_messages)
+    except Exception:
+        staff = False
+    return member.display_name, avatar, staff
 
-        uid = int(m.get("author_id", 0))
+def guild_lookup(guild) -> Callable[[int], Optional[Tuple[str, str, bool]]]:
+    """Respaldo para autores sin snapshot (tickets anteriores a ticket_authors): la caché de miembros del guild."""
+    def lookup(uid: int):
         member = guild.get_member(uid) if guild else None
-        name = (member.display_name if member else str(uid))
-        avatar = ""
-        try:
-            if member:
-                avatar = member.display_avatar.url
-        except Exception:
-            avatar = ""
+        return member_snapshot(member) if member else None
+    return lookup
+
+def author_profile(uid: int, opener_id: int, snap: Optional[Tuple[str, str, bool]]) -> Tuple[str, str, str]:
+    """Fragmentos HTML ya escapados de un autor: (avatar, clase de burbuja, cabecera sin hora)."""
+    name, avatar, staff = snap if snap else (str(uid), "", False)
+    badges = []
+    classes = []
+    if staff:
+        badges.append('<span class="badge staff">Staff</span>')
+        classes.append("staff")
+    if uid == opener_id:
+        badges.append('<span class="badge opener">Autor</span>')
+        classes.append("opener")
+    avatar_html = f'<div class="avatar"><img src="{esc(avatar)}" alt="avatar"></div>' if avatar else '<div class="avatar"></div>'
+    bubble = "".join(" " + c for c in classes)
+    head = f'<span class="name">{esc(name)}</span>{" ".join(badges)}'
+    return avatar_html, bubble, head
+
+class TranscriptHtmlWriter:
+    """Escribe la transcripción por bloques en un archivo binario.
 
-        badges = []
-        bubble_cls = ""
+    Los autores salen de `snapshots` (ticket_authors); `lookup` solo se usa para los que no tienen
+    snapshot y es lo único que puede tocar objetos de discord, así que `__init__` y `resolve_authors`
+    corren en el loop. `begin`/`write_messages`/`end` son CPU pura y pueden ir a un hilo.
+    """
+    def __init__(self, out: BinaryIO, guild, tinfo: Dict, opener_name: str, use_msg_intent: bool,
+                 snapshots: Optional[Dict[int, Tuple[str, str, bool]]] = None, lookup: Optional[Callable] = None):
+        self.out = out
+        self.opener_id = int(tinfo.get("opener_id", -1))
+        self.snapshots = snapshots or {}
+        self.lookup = lookup
+        self.lookups = 0
+        self.authors: Dict[int, Tuple[str, str, str]] = {}
+        self.current_day = None
+        self.count = 0
+        self._header = self._render_header(guild, tinfo, opener_name, use_msg_intent)
+
+    def _snapshot(self, uid: int):
+        snap = self.snapshots.get(uid)
+        if snap is None and self.lookup:
+            self.lookups += 1
+            snap = self.lookup(uid)
+        return snap
+
+    def _render_header(self, guild, tinfo: Dict, opener_name: str, use_msg_intent: bool) -> str:
+        gname = getattr(guild, "name", "Servidor")
+        title = f"Ticket #{tinfo['id']} — {gname}"
+        kind = tinfo.get("kind","?")
+        claimed_by = tinfo.get("claimed_by")
+        parts = [f'<div class="header"><h1>{esc(title)}</h1>',
+                 f'<span class="pill">Tipo: {esc(kind)}</span>',
+                 f'<span class="pill">Abierto por: {esc(opener_name)}</span>']
+        if claimed_by:
+            sname = str(claimed_by)
+            try:
+                snap = self._snapshot(int(claimed_by))
+                if snap:
+                    sname = snap[0]
+            except Exception:
+                pass
+            parts.append(f'<span class="pill">Reclamado por: {esc(sname)}</span>')
+        created_at = tinfo.get("created_at")
+        closed_at = tinfo.get("closed_at") or created_at
         try:
-            if member and member.guild_permissions.manage_messages:
-                badges.append('<span class="badge staff">Staff</span>')
-                bubble_cls = " staff"
+            c1 = created_at.strftime("%Y-%m-%d %H:%M")
+            c2 = closed_at.strftime("%Y-%m-%d %H:%M")
         except Exception:
-            pass
-        if uid == int(tinfo.get("opener_id", -1)):
-            badges.append('<span class="badge opener">Autor</span>')
-            bubble_cls = (bubble_cls + " opener").strip()
-
-        content = m.get("content","")
-        content_html = linkify(content)
-        atts = m.get("attachments") or []
-        att_html = ""
-        if atts:
-            links = " • ".join(f'<a href="{esc(url)}" target="_blank">{esc(url)}</a>' for url in atts if url)
-            att_html = f'<div class="atts">Adjuntos: {links}</div>'
-
-        parts.append('<div class="msg">')
-        if avatar:
-            parts.append(f'<div class="avatar"><img src="{esc(avatar)}" alt="avatar"></div>')
-        else:
-            parts.append(f'<div class="avatar"></div>')
-        parts.append(f'<div class="bubble{ " " + bubble_cls if bubble_cls else ""}">')
-        parts.append(f'<div class="head"><span class="name">{esc(name)}</span>{" ".join(badges)}<span class="time">{esc(stamp)}</span></div>')
-        parts.append(f'<div class="content">{content_html}</div>')
-        if att_html:
-            parts.append(att_html)
-        parts.append('</div></div>')
-
-    parts.append(FOOT)
-    return "".join(parts).encode("utf-8")
+            c1 = c2 = "—"
+        parts.append(f'<div class="note">Período: {esc(c1)} → {esc(c2)}</div>')
+        if not use_msg_intent:
+            parts.append('<div class="note" style="color:#ffb4b4">⚠️ El bot no tenía Message Content Intent activo: los textos pueden aparecer vacíos.</div>')
+        parts.append('</div>')
+        return "".join(parts)
+
+    def resolve_authors(self, messages: Iterable[Dict]):
+        for m in messages:
+            uid = int(m.get("author_id", 0))
+            if uid not in self.authors:
+                self.authors[uid] = author_profile(uid, self.opener_id, self._snapshot(uid))
+
+    def begin(self):
+        self.out.write((CSS + self._header).encode("utf-8"))
+
+    def write_messages(self, messages: Iterable[Dict]):
+        parts = []
+        n = 0
+        for m in messages:
+            ts = m.get("created_at")
+            try:
+                stamp = ts.strftime("%Y-%m-%d %H:%M:%S")
+            except Exception:
+                stamp = ""
+            day_key = stamp[:10]
+            if day_key and day_key != self.current_day:
+                self.current_day = day_key
+                parts.append(f'<div class="day">{esc(day_key)}</div>')
+
+            uid = int(m.get("author_id", 0))
+            prof = self.authors.get(uid)
+            if prof is None:  # no pasó por resolve_authors: solo su snapshot, sin consultar miembros
+                prof = self.authors[uid] = author_profile(uid, self.opener_id, self.snapshots.get(uid))
+            avatar_html, bubble, head = prof
+
+            parts.append('<div class="msg">')
+            parts.append(avatar_html)
+            parts.append(f'<div class="bubble{bubble}">')
+            parts.append(f'<div class="head">{head}<span class="time">{stamp}</span></div>')
+            parts.append(f'<div class="content">{linkify(m.get("content",""))}</div>')
+            atts = m.get("attachments") or []
+            if atts:
+                links = " • ".join(f'<a href="{esc(url)}" target="_blank">{esc(url)}</a>' for url in atts if url)
+                parts.append(f'<div class="atts">Adjuntos: {links}</div>')
+            parts.append('</div></div>')
+            n += 1
+            if n % CHUNK_MESSAGES == 0:
+                self.out.write("".join(parts).encode("utf-8"))
+                parts.clear()
+        if parts:
+            self.out.write("".join(parts).encode("utf-8"))
+        self.count += n
+
+    def end(self):
+        self.out.write(FOOT.encode("utf-8"))
+
+    def render_all(self, messages: List[Dict]):
+        self.begin()
+        self.write_messages(messages)
+        self.end()
+
+async def render_transcript_html(guild, tinfo: Dict, messages: List[Dict], opener_name: str, use_msg_intent: bool,
+                                 snapshots: Optional[Dict[int, Tuple[str, str, bool]]] = None) -> bytes:
+    out = io.BytesIO()
+    w = TranscriptHtmlWriter(out, guild, tinfo, opener_name, use_msg_intent, snapshots, guild_lookup(guild))
+    w.resolve_authors(messages)  # como mucho una consulta de miembro por autor sin snapshot, en el loop
+    await asyncio.to_thread(w.render_all, messages)
+    return out.getvalue()
+
+if __name__ == "__main__":
+    # benchmark: python transcript_html.py [n ...]
+    # "loop" es el mayor hueco visto por una tarea que late cada 10 ms mientras se renderiza
+    import sys, time
+    from datetime import datetime, timedelta, timezone
+
+    def fake_messages(n: int) -> List[Dict]:
+        t0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        return [{"author_id": 1000 + (i % 7), "created_at": t0 + timedelta(seconds=30 * i),
+                 "content": f"mensaje {i} <b>hola</b> mira https://example.com/p/{i} por favor",
+                 "attachments": [f"https://cdn.example.com/a/{i}.png"] if i % 10 == 0 else []} for i in range(n)]
+
+    async def bench(msgs: List[Dict]):
+        tinfo = {"id": 1, "kind": "comprar", "opener_id": 1000, "created_at": msgs[0]["created_at"]}
+        worst = 0.0
+        async def heartbeat():
+            nonlocal worst
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                worst = max(worst, now - last - 0.01)
+                last = now
+        hb = asyncio.create_task(heartbeat())
+        await asyncio.sleep(0)
+        t = time.perf_counter()
+        body = await render_transcript_html(None, tinfo, msgs, "autor", True)
+        ms = (time.perf_counter() - t) * 1000
+        await asyncio.sleep(0.02)  # dejar que el latido registre un bloqueo al final
+        hb.cancel()
+        return ms, len(body), worst * 1000
+
+    for n in [int(a) for a in sys.argv[1:]] or [1_000, 10_000, 100_000]:
+        ms, size, lag = asyncio.run(bench(fake_messages(n)))
+        print(f"{n:>7} mensajes: {ms:8.1f} ms  {size / 1024:9.1f} KiB  loop {lag:6.1f} ms")